@@ -0,0 +1,139 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, NamedTuple, Tuple
+
+from db import DB_POOL_MAX_SIZE
+from metrics import metrics
+
+
+class AdmissionClass(NamedTuple):
+    priority: int
+    # Сколько запросов класса одновременно держат соединение с БД.
+    limit: int
+    # Сколько можно ждать в очереди, прежде чем ответить 503.
+    budget: float
+    # Длиннее очередь — отказ сразу, не дожидаясь бюджета.
+    max_queue: int
+
+
+class Overloaded(Exception):
+    def __init__(self, request_class: str, retry_after: int):
+        super().__init__(request_class)
+        self.request_class = request_class
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    # Общий лимит на обращения к БД с приоритетами: освободившееся место
+    # получает самый приоритетный ожидающий, чей класс не выбрал свой лимит.
+    def __init__(self, capacity: int, classes: Dict[str, AdmissionClass]):
+        self.capacity = capacity
+        self.classes = classes
+        self.in_use = 0
+        self.active: Dict[str, int] = {name: 0 for name in classes}
+        self.waiting: Dict[str, int] = {name: 0 for name in classes}
+        self._waiters: List[Tuple[int, int, str, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    @asynccontextmanager
+    async def slot(self, request_class: str):
+        await self.acquire(request_class)
+        try:
+            yield
+        finally:
+            self.release(request_class)
+
+    async def acquire(self, request_class: str):
+        config = self.classes[request_class]
+        if self.waiting[request_class] >= config.max_queue:
+            self._shed(request_class)
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (config.priority, next(self._counter), request_class, future))
+        self._set_waiting(request_class, 1)
+        # Если место есть и впереди никого, _wake выдаст его сразу.
+        self._wake()
+        if future.done():
+            return
+        started = time.monotonic()
+        try:
+            await asyncio.wait({future}, timeout=config.budget)
+        except asyncio.CancelledError:
+            self._abandon(request_class, future)
+            raise
+        metrics.inc("admission_wait_seconds_total", time.monotonic() - started, request_class=request_class)
+        if not future.done():
+            self._abandon(request_class, future)
+            self._shed(request_class)
+        # Место уже засчитано за нами в _wake.
+
+    def release(self, request_class: str):
+        self.in_use -= 1
+        self.active[request_class] -= 1
+        metrics.set("admission_active", self.active[request_class], request_class=request_class)
+        self._wake()
+
+    def _has_room(self, request_class: str) -> bool:
+        return self.in_use < self.capacity and self.active[request_class] < self.classes[request_class].limit
+
+    def _take(self, request_class: str):
+        self.in_use += 1
+        self.active[request_class] += 1
+        metrics.inc("admission_admitted_total", request_class=request_class)
+        metrics.set("admission_active", self.active[request_class], request_class=request_class)
+
+    def _wake(self):
+        skipped = []
+        while self._waiters and self.in_use < self.capacity:
+            entry = heapq.heappop(self._waiters)
+            request_class, future = entry[2], entry[3]
+            if future.done():
+                continue
+            if not self._has_room(request_class):
+                skipped.append(entry)
+                continue
+            self._take(request_class)
+            self._set_waiting(request_class, -1)
+            future.set_result(None)
+        for entry in skipped:
+            heapq.heappush(self._waiters, entry)
+
+    def _abandon(self, request_class: str, future: asyncio.Future):
+        if future.done() and not future.cancelled():
+            # Место выдали в тот же момент, когда ожидание прервалось.
+            self.release(request_class)
+            return
+        future.cancel()
+        self._set_waiting(request_class, -1)
+        # Брошенные ожидания вычищаются в _wake, но при полной загрузке он до них не доходит.
+        if len(self._waiters) > 2 * sum(self.waiting.values()) + 64:
+            self._waiters = [entry for entry in self._waiters if not entry[3].done()]
+            heapq.heapify(self._waiters)
+
+    def _set_waiting(self, request_class: str, delta: int):
+        self.waiting[request_class] += delta
+        metrics.set("admission_queue_depth", self.waiting[request_class], request_class=request_class)
+
+    def _shed(self, request_class: str):
+        metrics.inc("admission_shed_total", request_class=request_class)
+        budget = self.classes[request_class].budget
+        raise Overloaded(request_class, retry_after=max(1, math.ceil(budget * 2)))
+
+
+def _share(fraction: float) -> int:
+    return max(1, int(DB_POOL_MAX_SIZE * fraction))
+
+
+# Приоритет: приём показаний > клинические записи > дашборды > выгрузки.
+admission = AdmissionController(
+    capacity=DB_POOL_MAX_SIZE,
+    classes={
+        "ingestion": AdmissionClass(priority=0, limit=_share(1.0), budget=2.0, max_queue=1000),
+        "clinical": AdmissionClass(priority=1, limit=_share(0.75), budget=1.0, max_queue=200),
+        "dashboard": AdmissionClass(priority=2, limit=_share(0.5), budget=0.25, max_queue=100),
+        "export": AdmissionClass(priority=3, limit=_share(0.25), budget=5.0, max_queue=10),
+    },
+)
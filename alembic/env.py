@@ -36,7 +36,11 @@ fileConfig(config.config_file_name)
 # my_important_option = config.get_main_option("my_important_option")
 # ... etc.
 
-config.set_main_option("sqlalchemy.url", os.environ["DATABASE_URL"])
+# -x database_url=...: прогнать миграции на другом шарде (см. shards.py).
+config.set_main_option(
+    "sqlalchemy.url",
+    context.get_x_argument(as_dictionary=True).get("database_url") or os.environ["DATABASE_URL"],
+)
 
 
 def run_migrations_offline():
@@ -76,8 +80,20 @@ def run_migrations_online():
         poolclass=pool.NullPool,
     )
 
+    # -x online=true: каждая миграция в своей транзакции, а DDL, не получивший
+    # блокировку за lock_timeout, падает, а не выстраивает очередь из записей.
+    # См. online_migrations.py.
+    x_arguments = context.get_x_argument(as_dictionary=True)
+    online = x_arguments.get("online", "false").lower() in ("1", "true", "yes")
+
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
+        if online:
+            connection.execute("SET lock_timeout = '{}'".format(x_arguments.get("lock_timeout", "5s")))
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            transaction_per_migration=online,
+        )
 
         with context.begin_transaction():
             context.run_migrations()
@@ -0,0 +1,39 @@
+"""insertion keys for analyses and prescriptions
+
+Revision ID: 2f7c9d1e4b86
+Revises: 6a1f4d8c2e93
+Create Date: 2026-10-19 23:12:40.318592
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import backfill, create_index, drop_index, set_not_null
+
+
+# revision identifiers, used by Alembic.
+revision = '2f7c9d1e4b86'
+down_revision = '6a1f4d8c2e93'
+branch_labels = None
+depends_on = None
+
+# id анализов и назначений теперь выдаёт последовательность каталога, и по нему
+# больше нельзя судить о порядке вставки на шарде: для переноса нужен свой номер.
+TABLES = (('rozbory', 'user_id'), ('jmenovani', 'user_id'))
+
+
+def upgrade():
+    for table, entity in TABLES:
+        op.execute("CREATE SEQUENCE {}_row_id_seq".format(table))
+        op.add_column(table, sa.Column('row_id', sa.BigInteger(), nullable=True))
+        op.execute("ALTER TABLE {0} ALTER COLUMN row_id SET DEFAULT nextval('{0}_row_id_seq')".format(table))
+        op.execute("ALTER SEQUENCE {0}_row_id_seq OWNED BY {0}.row_id".format(table))
+        backfill(table, "row_id = nextval('{}_row_id_seq')".format(table), "row_id IS NULL")
+        set_not_null(table, 'row_id')
+        create_index('ix_{}_{}_row_id'.format(table, entity), table, [entity, 'row_id'])
+
+
+def downgrade():
+    for table, entity in TABLES:
+        drop_index('ix_{}_{}_row_id'.format(table, entity))
+        op.drop_column(table, 'row_id')
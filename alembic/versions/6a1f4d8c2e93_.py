@@ -0,0 +1,58 @@
+"""fenced shard moves: insertion keys, fences, patient catalog
+
+Revision ID: 6a1f4d8c2e93
+Revises: b93d6f1e0c47
+Create Date: 2026-10-19 20:31:55.904418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import backfill, create_index, drop_index, set_not_null
+
+
+# revision identifiers, used by Alembic.
+revision = '6a1f4d8c2e93'
+down_revision = 'b93d6f1e0c47'
+branch_labels = None
+depends_on = None
+
+TABLES = (('stats_patient', 'user_id'), ('stats_room', 'room_id'), ('room_params', 'room_id'))
+
+
+def upgrade():
+    op.create_table('patient_rooms',
+    sa.Column('user_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('room_id', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    # На шарде 0 это весь каталог, пока шардов нет. Пациентов, размещённых на других шардах,
+    # дописывает python rebalance.py sync-patients.
+    op.execute(
+        "INSERT INTO patient_rooms (user_id, room_id) "
+        "SELECT DISTINCT ON (user_id) user_id, room_id FROM users_rooms ORDER BY user_id"
+    )
+    op.create_table('shard_fences',
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('entity_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.PrimaryKeyConstraint('kind', 'entity_id')
+    )
+    for table, entity in TABLES:
+        # Колонка без default и default отдельно — только правка каталога;
+        # старые строки нумеруются пачками, новые получают номер сразу.
+        op.execute("CREATE SEQUENCE {}_row_id_seq".format(table))
+        op.add_column(table, sa.Column('row_id', sa.BigInteger(), nullable=True))
+        op.execute("ALTER TABLE {0} ALTER COLUMN row_id SET DEFAULT nextval('{0}_row_id_seq')".format(table))
+        op.execute("ALTER SEQUENCE {0}_row_id_seq OWNED BY {0}.row_id".format(table))
+        backfill(table, "row_id = nextval('{}_row_id_seq')".format(table), "row_id IS NULL")
+        set_not_null(table, 'row_id')
+        create_index('ix_{}_{}_row_id'.format(table, entity), table, [entity, 'row_id'])
+
+
+def downgrade():
+    for table, entity in TABLES:
+        drop_index('ix_{}_{}_row_id'.format(table, entity))
+        # Последовательность принадлежит колонке и удаляется вместе с ней.
+        op.drop_column(table, 'row_id')
+    op.drop_table('shard_fences')
+    op.drop_table('patient_rooms')
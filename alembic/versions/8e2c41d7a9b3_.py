@@ -0,0 +1,26 @@
+"""stats lookup indexes
+
+Revision ID: 8e2c41d7a9b3
+Revises: 4cdaa4e8ecba
+Create Date: 2026-10-19 17:02:11.418204
+
+"""
+
+
+# revision identifiers, used by Alembic.
+revision = '8e2c41d7a9b3'
+down_revision = '4cdaa4e8ecba'
+branch_labels = None
+depends_on = None
+
+# Индексы (entity, type, saved_at) строились по колонке type, которую следом
+# удаляет d1a6c8e4f273: b7d3e9f05a12 строит их сразу по type_id. Ревизия
+# оставлена пустой, чтобы не ломать цепочку у уже обновлённых БД.
+
+
+def upgrade():
+    pass
+
+
+def downgrade():
+    pass
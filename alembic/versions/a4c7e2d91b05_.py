@@ -0,0 +1,36 @@
+"""idempotency key for device readings
+
+Revision ID: a4c7e2d91b05
+Revises: f3b9a27c6d18
+Create Date: 2026-10-19 18:31:07.264890
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import create_index, drop_index
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c7e2d91b05'
+down_revision = 'f3b9a27c6d18'
+branch_labels = None
+depends_on = None
+
+TABLES = ('stats_patient', 'stats_room')
+
+
+def upgrade():
+    for table in TABLES:
+        # Колонки без default — только правка каталога, таблица не переписывается.
+        op.add_column(table, sa.Column('device_id', sa.String(), nullable=True))
+        op.add_column(table, sa.Column('seq', sa.BigInteger(), nullable=True))
+        create_index('ux_{}_device_seq'.format(table), table, ['device_id', 'seq'],
+                     unique=True, where='device_id IS NOT NULL')
+
+
+def downgrade():
+    for table in TABLES:
+        drop_index('ux_{}_device_seq'.format(table))
+        op.drop_column(table, 'seq')
+        op.drop_column(table, 'device_id')
@@ -0,0 +1,74 @@
+"""vital types dictionary, expand
+
+Revision ID: b7d3e9f05a12
+Revises: 8e2c41d7a9b3
+Create Date: 2026-10-19 17:21:40.772915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import (
+    add_foreign_key, backfill, begin_column_swap, create_index, drop_index, set_not_null,
+)
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d3e9f05a12'
+down_revision = '8e2c41d7a9b3'
+branch_labels = None
+depends_on = None
+
+# Первая половина перехода на компактные строки: пока работает старый код,
+# триггеры дублируют type -> type_id и value -> value__new (real).
+# Старые колонки удаляет d1a6c8e4f273 (ветка contract) после выкладки нового кода.
+TABLES = (
+    ('stats_patient', 'user_id', 'user'),
+    ('stats_room', 'room_id', 'room'),
+    ('room_params', 'room_id', 'room'),
+)
+
+
+def upgrade():
+    op.create_table('vital_types',
+    sa.Column('id', sa.SmallInteger(), autoincrement=True, nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.execute(
+        "CREATE OR REPLACE FUNCTION vital_type_id(type_name text) RETURNS smallint AS $$ "
+        "DECLARE result smallint; "
+        "BEGIN "
+        "SELECT id INTO result FROM vital_types WHERE name = type_name; "
+        "IF result IS NULL THEN "
+        "INSERT INTO vital_types (name) VALUES (type_name) ON CONFLICT (name) DO NOTHING RETURNING id INTO result; "
+        "IF result IS NULL THEN SELECT id INTO result FROM vital_types WHERE name = type_name; END IF; "
+        "END IF; "
+        "RETURN result; "
+        "END $$ LANGUAGE plpgsql"
+    )
+    for table, entity, prefix in TABLES:
+        # Новый код пишет только type_id.
+        op.alter_column(table, 'type', existing_type=sa.String(), nullable=True)
+        # Триггер value ставим первым: проход по type заполнит и value__new.
+        begin_column_swap(table, 'value', 'real', fill=False)
+        begin_column_swap(table, 'type', 'smallint', using='vital_type_id({})', new_column='type_id')
+        backfill(table, 'value__new = value::real', 'value__new IS NULL AND value IS NOT NULL')
+        create_index('ix_{}_{}_type_id_saved_at'.format(table, prefix), table, [entity, 'type_id', 'saved_at DESC'])
+        set_not_null(table, 'type_id')
+        add_foreign_key('{}_type_id_fkey'.format(table), table, 'type_id', 'vital_types')
+
+
+def downgrade():
+    for table, entity, prefix in TABLES:
+        drop_index('ix_{}_{}_type_id_saved_at'.format(table, prefix))
+        op.execute("DROP TRIGGER IF EXISTS {0}_type_sync ON {0}".format(table))
+        op.execute("DROP FUNCTION IF EXISTS {}_type_sync()".format(table))
+        op.execute("DROP TRIGGER IF EXISTS {0}_value_sync ON {0}".format(table))
+        op.execute("DROP FUNCTION IF EXISTS {}_value_sync()".format(table))
+        op.execute("ALTER TABLE {} DROP COLUMN IF EXISTS type_id".format(table))
+        op.execute("ALTER TABLE {} DROP COLUMN IF EXISTS value__new".format(table))
+        op.alter_column(table, 'type', existing_type=sa.String(), nullable=False)
+    op.execute("DROP FUNCTION IF EXISTS vital_type_id(text)")
+    op.drop_table('vital_types')
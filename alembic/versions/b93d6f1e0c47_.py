@@ -0,0 +1,24 @@
+"""windowed moments in series stats
+
+Revision ID: b93d6f1e0c47
+Revises: e7b40c2f9a61
+Create Date: 2026-10-19 19:58:44.602517
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b93d6f1e0c47'
+down_revision = 'e7b40c2f9a61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('series_stats', sa.Column('window_moments', sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('series_stats', 'window_moments')
@@ -0,0 +1,38 @@
+"""series stats checkpoints
+
+Revision ID: c8e51f3a7d24
+Revises: a4c7e2d91b05
+Create Date: 2026-10-19 18:52:19.508371
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8e51f3a7d24'
+down_revision = 'a4c7e2d91b05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('series_stats',
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('entity_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('type_id', sa.SmallInteger(), nullable=False),
+    sa.Column('count', sa.BigInteger(), nullable=False),
+    sa.Column('mean', sa.Float(), nullable=False),
+    sa.Column('m2', sa.Float(), nullable=False),
+    sa.Column('ewma', sa.Float(), nullable=True),
+    sa.Column('last_value', sa.Float(), nullable=True),
+    sa.Column('last_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('window_min', sa.Text(), nullable=True),
+    sa.Column('window_max', sa.Text(), nullable=True),
+    sa.ForeignKeyConstraint(['type_id'], ['vital_types.id'], ),
+    sa.PrimaryKeyConstraint('kind', 'entity_id', 'type_id')
+    )
+
+
+def downgrade():
+    op.drop_table('series_stats')
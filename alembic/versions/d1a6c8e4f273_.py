@@ -0,0 +1,43 @@
+"""vital types dictionary, contract
+
+Revision ID: d1a6c8e4f273
+Revises: b7d3e9f05a12
+Create Date: 2026-10-19 17:24:05.190388
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import backfill, finish_column_swap
+
+
+# revision identifiers, used by Alembic.
+revision = 'd1a6c8e4f273'
+down_revision = 'b7d3e9f05a12'
+branch_labels = ('contract',)
+depends_on = None
+
+# Отдельная ветка: upgrade expand@head её не трогает, старые колонки удаляются
+# только после выкладки нового кода (make migrate-contract). Следующие шаги
+# contract ставить поверх этой ревизии с depends_on на свою ревизию expand.
+# DROP COLUMN только помечает колонку удалённой: место в старых строках
+# освобождает переписывание таблицы (pg_repack), VACUUM его не вернёт.
+TABLES = ('stats_patient', 'stats_room', 'room_params')
+
+
+def upgrade():
+    for table in TABLES:
+        finish_column_swap(table, 'type', new_column='type_id')
+        finish_column_swap(table, 'value')
+    op.execute("DROP FUNCTION IF EXISTS vital_type_id(text)")
+
+
+def downgrade():
+    for table in TABLES:
+        op.add_column(table, sa.Column('type', sa.String(), nullable=True))
+        backfill(
+            table,
+            "type = (SELECT name FROM vital_types WHERE vital_types.id = {}.type_id)".format(table),
+            "type IS NULL",
+        )
+        op.alter_column(table, 'value', type_=sa.Float(), postgresql_using='value::double precision')
@@ -0,0 +1,31 @@
+"""idempotency key for room params
+
+Revision ID: e7b40c2f9a61
+Revises: c8e51f3a7d24
+Create Date: 2026-10-19 19:40:12.118034
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import create_index, drop_index
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b40c2f9a61'
+down_revision = 'c8e51f3a7d24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('room_params', sa.Column('device_id', sa.String(), nullable=True))
+    op.add_column('room_params', sa.Column('seq', sa.BigInteger(), nullable=True))
+    create_index('ux_room_params_device_seq', 'room_params', ['device_id', 'seq'],
+                 unique=True, where='device_id IS NOT NULL')
+
+
+def downgrade():
+    drop_index('ux_room_params_device_seq')
+    op.drop_column('room_params', 'seq')
+    op.drop_column('room_params', 'device_id')
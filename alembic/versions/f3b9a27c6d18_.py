@@ -0,0 +1,31 @@
+"""room shards catalog
+
+Revision ID: f3b9a27c6d18
+Revises: b7d3e9f05a12
+Create Date: 2026-10-19 18:05:42.730114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b9a27c6d18'
+down_revision = 'b7d3e9f05a12'
+# Основная ветка: всё, что совместимо с кодом, который выкладывается следом.
+# Удаления после выкладки — в ветке contract (d1a6c8e4f273).
+branch_labels = ('expand',)
+depends_on = None
+
+
+def upgrade():
+    # Новая пустая таблица: блокировок на существующих нет, можно и онлайн.
+    op.create_table('room_shards',
+    sa.Column('room_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('shard', sa.SmallInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('room_id')
+    )
+
+
+def downgrade():
+    op.drop_table('room_shards')
@@ -1,33 +1,136 @@
+import asyncio
+import logging
+import os
+import time
+
 from broadcaster import Broadcast
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
 
-from db import db
+from admission import Overloaded
+from db import db, spawn
+from hub import ChannelHub
+from metrics import metrics
 
-broadcast = Broadcast("memory://")
+logger = logging.getLogger(__name__)
 
-app = FastAPI(
-    title="Async FastAPI",
-    on_startup=[broadcast.connect],
-    on_shutdown=[broadcast.disconnect],
+broadcast = Broadcast("memory://")
+hub = ChannelHub(
+    broadcast,
+    replay_max_events=int(os.environ.get("REPLAY_MAX_EVENTS", "1000")),
+    replay_max_age=float(os.environ.get("REPLAY_MAX_AGE", "300")),
 )
 
+DIRECTORY_RELOAD_SECONDS = float(os.environ.get("DIRECTORY_RELOAD_SECONDS", "600"))
 
-@app.on_event("startup")
-async def startup():
-    await db.connect()
-    await broadcast.connect()
 
+def create_app() -> FastAPI:
+    application = FastAPI(title="Async FastAPI")
+    application.state.ready = False
+    application.state.startup_timings = {}
+    application.state.background_tasks = []
 
-@app.on_event("shutdown")
-async def shutdown():
-    await db.disconnect()
-    await broadcast.disconnect()
+    @application.on_event("startup")
+    async def startup():
+        # Импорт здесь, чтобы не тянуть репозитории при импорте app.
+        from directory import directory
+        from models import StatsPatientRepo
+        from shards import SHARD_MAP_RELOAD_SECONDS, shard_map
+        from spool import SpoolDrainer, spool
+        from streaming_stats import STATS_CHECKPOINT_SECONDS, streaming_stats
+        from vital_types import vital_type_cache
+        from warmup import warm_up
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+        timings = application.state.startup_timings
+        started = time.perf_counter()
+        await asyncio.gather(db.connect(), broadcast.connect(), shard_map.connect())
+        timings["connect"] = time.perf_counter() - started
+
+        warmup_started = time.perf_counter()
+        timings["warmed_connections"], _, _ = await asyncio.gather(
+            warm_up(db),
+            directory.load(db, shard_map.databases),
+            shard_map.load(),
+        )
+        # Статистике нужны имена типов, их загружает warm_up. Своей задачей: иначе соединение
+        # загрузки осталось бы за startup.
+        await spawn(streaming_stats.load(db))
+        timings["warmup"] = time.perf_counter() - warmup_started
+
+        directory.broadcast = broadcast
+        shard_map.directory = directory
+        vital_type_cache.replicas = shard_map.replicas
+        # Фоновые задачи — каждая со своим соединением, а не с унаследованным от startup:
+        # иначе, например, сохранение статистики попадало бы в открытую транзакцию выгрузки спула.
+        application.state.background_tasks.extend([
+            spawn(directory.listen(broadcast)),
+            spawn(directory.reload_periodically(db, DIRECTORY_RELOAD_SECONDS, shard_map.databases)),
+            spawn(shard_map.reload_periodically(SHARD_MAP_RELOAD_SECONDS)),
+            spawn(streaming_stats.checkpoint_periodically(db, STATS_CHECKPOINT_SECONDS)),
+        ])
+
+        if spool is not None:
+            spool.open()
+            drainer = SpoolDrainer(spool, StatsPatientRepo(database=db, shards=shard_map, stats=streaming_stats).push_spooled)
+            application.state.background_tasks.append(spawn(drainer.run()))
+
+        timings["total"] = time.perf_counter() - started
+        application.state.ready = True
+        logger.info("startup finished: %s", timings)
+
+    @application.on_event("shutdown")
+    async def shutdown():
+        application.state.ready = False
+        for task in application.state.background_tasks:
+            task.cancel()
+        await asyncio.gather(*application.state.background_tasks, return_exceptions=True)
+        from spool import spool
+        from streaming_stats import streaming_stats
+        if spool is not None:
+            spool.close()
+        try:
+            await streaming_stats.checkpoint(db)
+        except Exception as e:
+            logger.warning("final stats checkpoint failed: %r", e)
+        await hub.close()
+        from shards import shard_map
+        await asyncio.gather(db.disconnect(), broadcast.disconnect(), shard_map.disconnect())
+
+    @application.exception_handler(Overloaded)
+    async def overloaded(request: Request, error: Overloaded):
+        # Места в admission берут репозитории у самой БД: перегрузка в любом из них — 503.
+        return JSONResponse(
+            {"detail": "Service overloaded"},
+            status_code=503,
+            headers={"Retry-After": str(error.retry_after)},
+        )
+
+    @application.get("/health/live")
+    async def liveness():
+        return {"status": "alive"}
+
+    @application.get("/health/ready")
+    async def readiness():
+        if not application.state.ready:
+            return JSONResponse({"status": "warming_up"}, status_code=503)
+        return {"status": "ready", "startup": application.state.startup_timings}
+
+    @application.get("/metrics", response_class=PlainTextResponse)
+    async def metrics_endpoint():
+        metrics.set("ws_channels", hub.channels_count)
+        metrics.set("ws_dropped_events", hub.dropped)
+        return metrics.render()
+
+    application.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    return application
+
+
+app = create_app()
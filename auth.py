@@ -1,6 +1,26 @@
+import os
+from typing import Dict, Optional
+
 from fastapi import Header
 
 
 async def get_user_from_token(header=Header("", alias="Authorization"), ):
     token = header.replace("Bearer ", "")
     return token
+
+
+def _load_device_tokens() -> Dict[str, str]:
+    # DEVICE_TOKENS=monitor-1:secret1,monitor-2:secret2
+    tokens = {}
+    for pair in os.environ.get("DEVICE_TOKENS", "").split(","):
+        device_id, _, token = pair.strip().partition(":")
+        if device_id and token:
+            tokens[token] = device_id
+    return tokens
+
+
+_device_tokens = _load_device_tokens()
+
+
+def authenticate_device(token: str) -> Optional[str]:
+    return _device_tokens.get(token.replace("Bearer ", ""))
@@ -0,0 +1,95 @@
+import asyncio
+import functools
+import inspect
+import time
+from typing import Any, Dict, Set, Tuple
+
+from metrics import metrics
+
+MAX_CACHED_KEYS = 1024
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
+def coalesced(ttl: float = 0.0):
+    # Одинаковые одновременные вызовы метода репозитория (те же аргументы и та же БД)
+    # ждут один общий запрос. ttl > 0 — результат ещё столько секунд отдаётся из памяти.
+    # Результат общий для всех вызвавших, менять его нельзя.
+    def decorator(method):
+        name = method.__qualname__
+        signature = inspect.signature(method)
+        in_flight: Dict[Tuple, asyncio.Future] = {}
+        cache: Dict[Tuple, Tuple[float, Any]] = {}
+        # Запросы, начатые до invalidate: их результат уже не кэшируем и новых ждущих к ним не пускаем.
+        stale: Set[asyncio.Future] = set()
+
+        def _key(self, args, kwargs) -> Tuple:
+            # По именам аргументов: f(1, "hr") и f(room_id=1, type_="hr") — один ключ.
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = tuple((arg, _freeze(value)) for arg, value in list(bound.arguments.items())[1:])
+            return id(self.database), arguments
+
+        def invalidate(**match):
+            # Без аргументов — весь кэш, иначе только вызовы с такими значениями,
+            # например invalidate(room_id=3) после записи в палату 3.
+            match = {arg: _freeze(value) for arg, value in match.items()}
+
+            def matches(key) -> bool:
+                arguments = dict(key[1])
+                return all(arguments.get(arg) == value for arg, value in match.items())
+
+            for key in [k for k in cache if matches(k)]:
+                del cache[key]
+            for key in [k for k in in_flight if matches(k)]:
+                stale.add(in_flight.pop(key))
+
+        def _finished(key, task: asyncio.Future):
+            if in_flight.get(key) is task:
+                del in_flight[key]
+            if task in stale:
+                stale.discard(task)
+                return
+            if task.cancelled() or task.exception() is not None:
+                return
+            if ttl > 0:
+                if len(cache) >= MAX_CACHED_KEYS:
+                    now = time.monotonic()
+                    for expired in [k for k, (expires, _) in cache.items() if expires <= now]:
+                        del cache[expired]
+                cache[key] = (time.monotonic() + ttl, task.result())
+
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            key = _key(self, args, kwargs)
+            metrics.inc("coalesce_calls_total", method=name)
+            if ttl > 0:
+                cached = cache.get(key)
+                if cached is not None and cached[0] > time.monotonic():
+                    metrics.inc("coalesce_cache_hits_total", method=name)
+                    return cached[1]
+            task = in_flight.get(key)
+            if task is None:
+                metrics.inc("coalesce_queries_total", method=name)
+                # Запрос живёт в своей задаче: отмена одного из ждущих не рвёт его остальным.
+                task = in_flight[key] = asyncio.ensure_future(method(self, *args, **kwargs))
+                task.add_done_callback(functools.partial(_finished, key))
+            else:
+                metrics.inc("coalesce_shared_total", method=name)
+            calls = metrics.get("coalesce_calls_total", method=name)
+            queries = metrics.get("coalesce_queries_total", method=name)
+            metrics.set("coalesce_fan_in", calls / queries, method=name)
+            return await asyncio.shield(task)
+
+        wrapper.invalidate = invalidate
+        return wrapper
+
+    return decorator
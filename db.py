@@ -1,3 +1,5 @@
+import asyncio
+import contextvars
 import os
 from databases import Database
 from dotenv import load_dotenv
@@ -6,6 +8,20 @@ import sqlalchemy
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 load_dotenv(os.path.join(BASE_DIR, ".env"))
 
-db = Database(os.environ["DATABASE_URL"])
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "20"))
+
+db = Database(
+    os.environ["DATABASE_URL"],
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+)
 
 metadata = sqlalchemy.MetaData()
+
+
+def spawn(coroutine) -> asyncio.Task:
+    # databases держит соединение задачи в contextvar, а задача наследует контекст
+    # родителя: запущенные из задачи, уже обращавшейся к БД, делили бы одно соединение.
+    # Из пустого контекста задача берёт из пула своё.
+    return contextvars.Context().run(asyncio.ensure_future, coroutine)
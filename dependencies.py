@@ -1,14 +1,18 @@
 from db import db
+from directory import directory
 from models import UsersRepository, RoomsRepository, StatsPatientRepo
+from shards import shard_map
+from spool import spool
+from streaming_stats import streaming_stats
 
 
 def get_user_repository():
-    return UsersRepository(database=db)
+    return UsersRepository(database=db, directory=directory, shards=shard_map)
 
 
 def get_rooms_repo():
-    return RoomsRepository(database=db)
+    return RoomsRepository(database=db, directory=directory, shards=shard_map)
 
 
 def get_room_stats_repo() -> StatsPatientRepo:
-    return StatsPatientRepo(database=db)
+    return StatsPatientRepo(database=db, spool=spool, shards=shard_map, stats=streaming_stats)
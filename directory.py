@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+import uuid
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from broadcaster import Broadcast
+from databases import Database
+
+from tables import rooms, users, users_rooms
+
+logger = logging.getLogger(__name__)
+
+DIRECTORY_CHANNEL = "__directory__"
+
+
+class UserEntry(NamedTuple):
+    login: str
+    first_name: Optional[str]
+    second_name: Optional[str]
+    last_name: Optional[str]
+
+
+class WardDirectory:
+    # Палаты, пользователи и размещение пациентов целиком в памяти процесса.
+    # Меняются редко (поступление, перевод), поэтому грузим один раз и дальше
+    # применяем изменения из уведомлений.
+    def __init__(self):
+        self.ready = False
+        self.origin = uuid.uuid4().hex
+        self.broadcast: Optional[Broadcast] = None
+        self.rooms: Dict[int, str] = {}
+        self.users: Dict[int, UserEntry] = {}
+        self.logins: Dict[str, int] = {}
+        self.room_patients: Dict[int, Set[int]] = {}
+        self.patient_room: Dict[int, int] = {}
+
+    async def load(self, database: Database, partitions: Optional[List[Database]] = None):
+        # users одинаковы на всех шардах, палаты и размещение — у каждого шарда свои.
+        partitions = partitions or [database]
+        users_rows, *parts = await asyncio.gather(
+            database.fetch_all(users.select()),
+            *(
+                asyncio.gather(partition.fetch_all(rooms.select()), partition.fetch_all(users_rooms.select()))
+                for partition in partitions
+            ),
+        )
+        loaded = WardDirectory()
+        for row in users_rows:
+            loaded._add_user(row.get("id"), row.get("login"), row.get("first_name"),
+                             row.get("second_name"), row.get("last_name"))
+        for rooms_rows, membership_rows in parts:
+            for row in rooms_rows:
+                loaded.rooms[row.get("id")] = row.get("name")
+            for row in membership_rows:
+                loaded._move(row.get("user_id"), row.get("room_id"))
+        # Подменяем индексы целиком, чтобы читатели не видели полузагруженное состояние.
+        self.rooms, self.users, self.logins = loaded.rooms, loaded.users, loaded.logins
+        self.room_patients, self.patient_room = loaded.room_patients, loaded.patient_room
+        self.ready = True
+
+    def get_user(self, user_id) -> Optional[UserEntry]:
+        try:
+            return self.users.get(int(user_id))
+        except (TypeError, ValueError):
+            return None
+
+    def get_user_id_by_login(self, login: str) -> Optional[int]:
+        return self.logins.get(login)
+
+    def get_patients(self, room_id: int) -> List[int]:
+        return sorted(self.room_patients.get(room_id, ()))
+
+    def get_room_of(self, patient_id: int) -> Optional[int]:
+        return self.patient_room.get(patient_id)
+
+    def apply(self, event: dict):
+        kind = event.get("type")
+        if kind == "room_created":
+            self.rooms[event["id"]] = event["name"]
+        elif kind == "user_created":
+            self._add_user(event["id"], event["login"], event.get("first_name"),
+                           event.get("second_name"), event.get("last_name"))
+            if event.get("room_id") is not None:
+                self._move(event["id"], event["room_id"])
+        elif kind == "user_moved":
+            self._move(event["user_id"], event["room_id"])
+
+    async def notify(self, event: dict):
+        self.apply(event)
+        if self.broadcast is not None:
+            message = json.dumps(dict(event, origin=self.origin))
+            await self.broadcast.publish(channel=DIRECTORY_CHANNEL, message=message)
+
+    async def listen(self, broadcast: Broadcast):
+        # Изменения из других процессов; свои уже применены в notify.
+        async with broadcast.subscribe(channel=DIRECTORY_CHANNEL) as subscriber:
+            try:
+                async for event in subscriber:
+                    payload = json.loads(event.message)
+                    if payload.get("origin") != self.origin:
+                        self.apply(payload)
+            except asyncio.CancelledError:
+                pass
+
+    async def reload_periodically(self, database: Database, interval: float,
+                                  partitions: Optional[List[Database]] = None):
+        # Страховка от правок в обход приложения.
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.load(database, partitions)
+            except Exception as e:
+                logger.warning("directory reload failed: %r", e)
+
+    def _add_user(self, user_id: int, login: str, first_name, second_name, last_name):
+        self.users[user_id] = UserEntry(login, first_name, second_name, last_name)
+        self.logins[login] = user_id
+
+    def _move(self, user_id: int, room_id: int):
+        previous = self.patient_room.get(user_id)
+        if previous is not None:
+            self.room_patients.get(previous, set()).discard(user_id)
+        self.patient_room[user_id] = room_id
+        self.room_patients.setdefault(room_id, set()).add(user_id)
+
+
+directory = WardDirectory()
@@ -0,0 +1,243 @@
+import asyncio
+import datetime
+import json
+import logging
+import time
+from typing import List, Optional, Tuple
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from admission import Overloaded
+from auth import authenticate_device
+from metrics import metrics
+from models import RETRYABLE_ERRORS, Reading, StatsPatientRepo, utcnow
+from spool import SpoolFull
+
+logger = logging.getLogger(__name__)
+
+MAX_WINDOW = 32
+MAX_BATCH_READINGS = 1000
+MAX_WRITE_ROWS = 5000
+# Целевое время одной записи в БД: дольше — сжимаем окно устройства.
+TARGET_WRITE_SECONDS = 0.2
+# Показания "из будущего" дальше этого — часы устройства убежали, ставим время приёма.
+MAX_CLOCK_SKEW = datetime.timedelta(seconds=60)
+# Пачку не записали, но после паузы её примут: nack, а не reject. Переполненный спул — тоже.
+NACK_ERRORS = RETRYABLE_ERRORS + (SpoolFull,)
+
+_Batch = Tuple[int, List[Reading], List[Reading]]
+
+
+class InvalidBatch(Exception):
+    def __init__(self, message: str, batch_id: Optional[int] = None):
+        super().__init__(message)
+        # Номер пачки, если его удалось прочитать: по нему устройство поймёт, что отбросить.
+        self.batch_id = batch_id
+
+
+class FlowControl:
+    # AIMD: пока БД успевает, окно растёт на единицу, при медленной записи
+    # или ошибке — делится пополам.
+    def __init__(self, max_window: int = MAX_WINDOW, target: float = TARGET_WRITE_SECONDS):
+        self.max_window = max_window
+        self.target = target
+        self.window = max(max_window // 4, 1)
+
+    def on_write(self, seconds: float):
+        if seconds > self.target:
+            self.window = max(self.window // 2, 1)
+        else:
+            self.window = min(self.window + 1, self.max_window)
+
+    def on_failure(self):
+        self.window = 1
+
+
+def parse_timestamp(value, received_at: datetime.datetime) -> datetime.datetime:
+    # Unix-время в секундах или ISO 8601; время без зоны — UTC.
+    # fromisoformat до Python 3.11 не понимает суффикс "Z", меняем его на +00:00.
+    if value is None:
+        return received_at
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        measured_at = datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+    else:
+        text = str(value)
+        if text[-1:] in ("Z", "z"):
+            text = text[:-1] + "+00:00"
+        measured_at = datetime.datetime.fromisoformat(text)
+        if measured_at.tzinfo is None:
+            measured_at = measured_at.replace(tzinfo=datetime.timezone.utc)
+    if measured_at - received_at > MAX_CLOCK_SKEW:
+        metrics.inc("ingest_clock_skew_total")
+        return received_at
+    return measured_at
+
+
+def parse_batch(
+        payload: dict,
+        received_at: datetime.datetime,
+        device_id: Optional[str] = None,
+) -> _Batch:
+    try:
+        batch_id = int(payload["id"])
+        readings = payload["readings"]
+    except (KeyError, TypeError, ValueError):
+        raise InvalidBatch("batch must have id and readings")
+    if not isinstance(readings, list) or len(readings) > MAX_BATCH_READINGS:
+        raise InvalidBatch("readings must be a list of at most {}".format(MAX_BATCH_READINGS), batch_id)
+    patients, rooms = [], []
+    for reading in readings:
+        try:
+            type_ = str(reading["type"])
+            value = float(reading["value"])
+            saved_at = parse_timestamp(reading.get("ts"), received_at)
+            seq = int(reading["seq"]) if reading.get("seq") is not None else None
+            if "patient_id" in reading:
+                patients.append(Reading(int(reading["patient_id"]), type_, value, saved_at, device_id, seq))
+            else:
+                rooms.append(Reading(int(reading["room_id"]), type_, value, saved_at, device_id, seq))
+        except (KeyError, TypeError, ValueError, OverflowError, OSError):
+            raise InvalidBatch("reading needs patient_id or room_id, type and value; ts and seq are optional", batch_id)
+    return batch_id, patients, rooms
+
+
+class DeviceSession:
+    # Долгоживущее соединение монитора. Протокол:
+    #   сервер -> {"type": "hello", "device_id": ..., "window": W}
+    #   клиент -> {"type": "batch", "id": N, "readings": [{"patient_id" | "room_id", "type", "value", "ts", "seq"}]}
+    #   сервер -> {"type": "ack", "ids": [...], "window": W} после записи в БД
+    #             {"type": "nack", "ids": [...], "detail": ...} — пачку надо переслать
+    #             {"type": "reject", "ids": [...], "detail": ...} — пачку БД не примет никогда
+    #             (например, неизвестный тип показателя или битое показание), не пересылать
+    # W — сколько неподтверждённых пачек устройство может держать в полёте; сверх
+    # этого сервер не читает сокет, и устройство притормаживает уже TCP.
+    # ts — время измерения на устройстве, seq — сквозной номер показания у устройства:
+    # с ним переотправленная после nack или обрыва связи пачка не задваивает строки.
+    def __init__(self, websocket: WebSocket, device_id: str, repository: StatsPatientRepo):
+        self.websocket = websocket
+        self.device_id = device_id
+        self.repository = repository
+        self.flow = FlowControl()
+        self.pending: asyncio.Queue = asyncio.Queue(maxsize=MAX_WINDOW)
+        # Принятые, но ещё не подтверждённые пачки.
+        self.in_flight = 0
+        self._window_changed = asyncio.Event()
+
+    async def send(self, message: dict):
+        await self.websocket.send_text(json.dumps(message))
+
+    async def answer(self, kind: str, ids: List[int], **extra):
+        self.in_flight -= len(ids)
+        self._window_changed.set()
+        await self.send(dict({"type": kind, "ids": ids, "window": self.flow.window}, **extra))
+
+    async def run(self):
+        metrics.inc("ingest_connections_total", device=self.device_id)
+        metrics.set("ingest_connected", 1, device=self.device_id)
+        await self.send({"type": "hello", "device_id": self.device_id, "window": self.flow.window})
+        writer = asyncio.ensure_future(self.write_loop())
+        try:
+            await self.receive_loop()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            writer.cancel()
+            metrics.set("ingest_connected", 0, device=self.device_id)
+
+    async def receive_loop(self):
+        while True:
+            while self.in_flight >= self.flow.window:
+                self._window_changed.clear()
+                await self._window_changed.wait()
+            text = await self.websocket.receive_text()
+            metrics.inc("ingest_bytes_total", len(text), device=self.device_id)
+            try:
+                payload = json.loads(text)
+                batch = parse_batch(payload, utcnow(), self.device_id)
+            except (ValueError, InvalidBatch) as e:
+                metrics.inc("ingest_rejected_total", device=self.device_id)
+                # Пачка с номером не станет валиднее от пересылки. Без номера сказать,
+                # какую пачку отбросить, нельзя — остаётся nack без ids.
+                batch_id = getattr(e, "batch_id", None)
+                if batch_id is None:
+                    await self.send({"type": "nack", "ids": [], "detail": str(e)})
+                else:
+                    await self.send({"type": "reject", "ids": [batch_id], "detail": str(e)})
+                continue
+            self.in_flight += 1
+            await self.pending.put(batch)
+            metrics.set("ingest_pending_batches", self.pending.qsize(), device=self.device_id)
+
+    async def write_loop(self):
+        while True:
+            batches = await self._collect()
+            ids = [batch[0] for batch in batches]
+            patients = [reading for batch in batches for reading in batch[1]]
+            rooms = [reading for batch in batches for reading in batch[2]]
+            started = time.perf_counter()
+            try:
+                await self.repository.push_batch(patients, rooms, create_types=False)
+            except Overloaded as e:
+                await self._overloaded(ids, e)
+                continue
+            except NACK_ERRORS as e:
+                await self._failed(ids, e)
+                continue
+            except Exception as e:
+                # Скорее всего, одна плохая пачка (например, неизвестный patient_id):
+                # пишем склеенные пачки по одной, чтобы она не тормозила остальные.
+                logger.warning("device %s merged write failed, retrying batch by batch: %r", self.device_id, e)
+                await self._write_separately(batches)
+                continue
+            elapsed = time.perf_counter() - started
+            self.flow.on_write(elapsed)
+            metrics.inc("ingest_batches_total", len(ids), device=self.device_id)
+            metrics.inc("ingest_readings_total", len(patients) + len(rooms), device=self.device_id)
+            metrics.inc("ingest_write_seconds_total", elapsed, device=self.device_id)
+            metrics.set("ingest_window", self.flow.window, device=self.device_id)
+            metrics.set("ingest_last_seen", time.time(), device=self.device_id)
+            await self.answer("ack", ids)
+
+    async def _write_separately(self, batches: List[_Batch]):
+        for batch_id, patients, rooms in batches:
+            try:
+                await self.repository.push_batch(patients, rooms, create_types=False)
+            except Overloaded as e:
+                await self._overloaded([batch_id], e)
+            except NACK_ERRORS as e:
+                await self._failed([batch_id], e)
+            except Exception as e:
+                logger.warning("device %s batch %s rejected: %r", self.device_id, batch_id, e)
+                metrics.inc("ingest_rejected_total", device=self.device_id)
+                await self.answer("reject", [batch_id], detail=str(e))
+            else:
+                metrics.inc("ingest_batches_total", device=self.device_id)
+                metrics.inc("ingest_readings_total", len(patients) + len(rooms), device=self.device_id)
+                await self.answer("ack", [batch_id])
+
+    async def _overloaded(self, ids: List[int], error: Overloaded):
+        self.flow.on_failure()
+        metrics.inc("ingest_shed_total", device=self.device_id)
+        await self.answer("nack", ids, detail="overloaded", retry_after=error.retry_after)
+
+    async def _failed(self, ids: List[int], error: Exception):
+        logger.warning("device %s write failed: %r", self.device_id, error)
+        self.flow.on_failure()
+        metrics.inc("ingest_write_failures_total", device=self.device_id)
+        await self.answer("nack", ids, detail="write failed")
+
+    async def _collect(self) -> List[_Batch]:
+        # Склеиваем всё, что накопилось, в одну запись.
+        batches, rows = [], 0
+        batch = await self.pending.get()
+        while True:
+            batches.append(batch)
+            rows += len(batch[1]) + len(batch[2])
+            if self.pending.empty() or rows >= MAX_WRITE_ROWS:
+                return batches
+            batch = self.pending.get_nowait()
+
+
+def device_from_websocket(websocket: WebSocket) -> Optional[str]:
+    token = websocket.headers.get("authorization") or websocket.query_params.get("token", "")
+    return authenticate_device(token)
@@ -0,0 +1,187 @@
+import asyncio
+import itertools
+import json
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from broadcaster import Broadcast
+
+
+class ReplayLog:
+    # Последние события канала, ограничены по количеству и по возрасту.
+    def __init__(self, max_events: int, max_age: float):
+        self.max_events = max_events
+        self.max_age = max_age
+        self.last_seq = 0
+        self.events: Deque[Tuple[int, float, str]] = deque()
+
+    def append(self, message: str) -> int:
+        self.last_seq += 1
+        self.events.append((self.last_seq, time.monotonic(), message))
+        self.trim()
+        return self.last_seq
+
+    def trim(self):
+        deadline = time.monotonic() - self.max_age
+        while self.events and (len(self.events) > self.max_events or self.events[0][1] < deadline):
+            self.events.popleft()
+
+    def since(self, last_seq: int) -> Optional[List[Tuple[int, str]]]:
+        # None — клиент отстал сильнее, чем хранит лог (или сервер перезапускался).
+        self.trim()
+        if last_seq > self.last_seq:
+            return None
+        first_seq = self.events[0][0] if self.events else self.last_seq + 1
+        if last_seq + 1 < first_seq:
+            return None
+        start = last_seq + 1 - first_seq
+        return [(seq, message) for seq, _, message in itertools.islice(self.events, start, None)]
+
+    def is_expired(self) -> bool:
+        self.trim()
+        return not self.events
+
+
+class ChannelHub:
+    # Одна подписка на брокер на канал в процессе. События раскладываются
+    # по очередям соединений, каждое соединение читает только свою очередь.
+    # Номера событий монотонны в пределах процесса: при нескольких воркерах
+    # на общем брокере каждый ведёт свою нумерацию, а после перезапуска она
+    # начинается заново. Поэтому каждое событие несёт epoch — id нумерации,
+    # и докачка по last_seq возможна, только если клиент прислал тот же epoch.
+    def __init__(
+            self,
+            broadcast: Broadcast,
+            queue_size: int = 1000,
+            replay_max_events: int = 1000,
+            replay_max_age: float = 300.0,
+    ):
+        self.broadcast = broadcast
+        self.queue_size = queue_size
+        self.replay_max_events = replay_max_events
+        self.replay_max_age = replay_max_age
+        self.dropped = 0
+        self._listeners: Dict[str, Dict[asyncio.Queue, int]] = {}
+        self._pumps: Dict[str, asyncio.Task] = {}
+        self._logs: Dict[str, ReplayLog] = {}
+        self._published = 0
+        self.epoch = uuid.uuid4().hex[:12]
+
+    @staticmethod
+    def is_reserved(channel: str) -> bool:
+        # Служебные каналы (например, уведомления справочника) клиентам недоступны.
+        return channel.startswith("__")
+
+    def queue(self, bounded: bool = True) -> asyncio.Queue:
+        # Неограниченная очередь — для старых клиентов без номеров событий:
+        # им не сообщить о выброшенном, поэтому ничего не выбрасываем.
+        return asyncio.Queue(maxsize=self.queue_size if bounded else 0)
+
+    def subscribe(
+            self,
+            channel: str,
+            queue: asyncio.Queue,
+            last_seq: Optional[int] = None,
+            epoch: Optional[str] = None,
+    ):
+        log = self._log(channel)
+        delivered = log.last_seq
+        if last_seq is not None:
+            # Номер из чужой нумерации (другой воркер, прошлый запуск) ничего не значит.
+            missed = log.since(last_seq) if epoch == self.epoch else None
+            if missed is None:
+                self.offer(queue, {"type": "resync", "channel": channel, "epoch": self.epoch, "seq": log.last_seq})
+            else:
+                for seq, message in missed:
+                    self.offer(queue, self._event(channel, self.epoch, seq, message))
+        # Регистрация и чтение лога идут без await между ними, поэтому события,
+        # которые насос доставит позже, отсекаются по delivered без дублей.
+        # Опубликованное до того, как насос подписался на брокер, он дошлёт из лога.
+        self._listeners.setdefault(channel, {})[queue] = delivered
+        if channel not in self._pumps:
+            self._pumps[channel] = asyncio.ensure_future(self._pump(channel))
+
+    def unsubscribe(self, channel: str, queue: asyncio.Queue):
+        listeners = self._listeners.get(channel)
+        if listeners is None:
+            return
+        listeners.pop(queue, None)
+        if not listeners:
+            del self._listeners[channel]
+            pump = self._pumps.pop(channel, None)
+            if pump is not None:
+                pump.cancel()
+
+    async def publish(self, channel: str, message: str):
+        seq = self._log(channel).append(message)
+        self._published += 1
+        if self._published % self.replay_max_events == 0:
+            self._expire_logs()
+        envelope = {"epoch": self.epoch, "seq": seq, "message": message}
+        await self.broadcast.publish(channel=channel, message=json.dumps(envelope))
+
+    async def close(self):
+        pumps = list(self._pumps.values())
+        self._pumps.clear()
+        self._listeners.clear()
+        for pump in pumps:
+            pump.cancel()
+        await asyncio.gather(*pumps, return_exceptions=True)
+
+    @property
+    def channels_count(self) -> int:
+        return len(self._pumps)
+
+    def offer(self, queue: asyncio.Queue, item: dict):
+        # Медленный клиент не должен тормозить остальных: выкидываем самое старое.
+        if queue.full():
+            queue.get_nowait()
+            self.dropped += 1
+        queue.put_nowait(item)
+
+    def _log(self, channel: str) -> ReplayLog:
+        log = self._logs.get(channel)
+        if log is None:
+            log = self._logs[channel] = ReplayLog(self.replay_max_events, self.replay_max_age)
+        return log
+
+    def _expire_logs(self):
+        for channel in [c for c, log in self._logs.items() if c not in self._listeners and log.is_expired()]:
+            del self._logs[channel]
+
+    def _catch_up(self, channel: str):
+        log = self._logs.get(channel)
+        listeners = self._listeners.get(channel, {})
+        if log is None:
+            return
+        for queue, delivered in tuple(listeners.items()):
+            for seq, message in log.since(delivered) or ():
+                listeners[queue] = seq
+                self.offer(queue, self._event(channel, self.epoch, seq, message))
+
+    @staticmethod
+    def _event(channel: str, epoch: str, seq: int, message: str) -> dict:
+        return {"type": "event", "channel": channel, "epoch": epoch, "seq": seq, "message": message}
+
+    async def _pump(self, channel: str):
+        async with self.broadcast.subscribe(channel=channel) as subscriber:
+            # Отмену гасим внутри with: иначе broadcaster не уберёт свою очередь из подписчиков.
+            try:
+                self._catch_up(channel)
+                async for event in subscriber:
+                    payload = json.loads(event.message)
+                    epoch, seq = payload.get("epoch"), payload["seq"]
+                    item = self._event(channel, epoch, seq, payload["message"])
+                    own = epoch == self.epoch
+                    listeners = self._listeners.get(channel, {})
+                    for queue, delivered in tuple(listeners.items()):
+                        # Чужие события (другой воркер) в наш лог не попадают, дублей по ним нет.
+                        if not own:
+                            self.offer(queue, item)
+                        elif seq > delivered:
+                            listeners[queue] = seq
+                            self.offer(queue, item)
+            except asyncio.CancelledError:
+                pass
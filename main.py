@@ -1,14 +1,21 @@
-from typing import List
+import asyncio
+import json
+from typing import List, Optional
 
-import uvicorn
 from fastapi import Depends
 from starlette.concurrency import run_until_first_complete
+from starlette.status import WS_1008_POLICY_VIOLATION
 from starlette.websockets import WebSocket
 
-from app import app, broadcast
+from app import app, hub
 from auth import get_user_from_token
-from dependencies import get_user_repository, get_rooms_repo
-from schema import RoomDTO
+from dependencies import get_user_repository, get_rooms_repo, get_room_stats_repo
+from directory import directory
+from gateway import DeviceSession, device_from_websocket
+from schema import RoomDTO, RoomStatsDTO
+from streaming_stats import streaming_stats
+
+MAX_SUBSCRIPTIONS = 200
 
 
 @app.get("/api/rooms", response_model=List[RoomDTO])
@@ -23,25 +30,141 @@ async def get_rooms(
     return await rooms_repository.get_all()
 
 
+@app.get("/api/rooms/{room_id}/stats", response_model=RoomStatsDTO)
+async def get_room_stats(room_id: int, user=Depends(get_user_from_token)):
+    # Из памяти: ни истории, ни БД не трогаем, поэтому и без admission.
+    return {
+        "room_id": room_id,
+        "room": streaming_stats.for_entity("room", room_id),
+        "patients": {
+            patient_id: streaming_stats.for_entity("patient", patient_id)
+            for patient_id in directory.get_patients(room_id)
+        },
+    }
+
+
 async def events_ws_receiver(websocket, channel: str):
     async for message in websocket.iter_text():
-        await broadcast.publish(channel=channel, message=message)
+        await hub.publish(channel=channel, message=message)
+
+
+async def events_ws_sender(websocket, channel: str, last_seq: Optional[int] = None, epoch: Optional[str] = None):
+    # Без last_seq — старый формат (голый текст), с ним — события с номерами и докачкой.
+    # Докачка — только при совпадении epoch из последнего полученного события, иначе resync.
+    queue = hub.queue(bounded=last_seq is not None)
+    hub.subscribe(channel, queue, last_seq=last_seq, epoch=epoch)
+    try:
+        while True:
+            item = await queue.get()
+            if last_seq is not None:
+                await websocket.send_text(json.dumps(item))
+            elif item["type"] == "event":
+                await websocket.send_text(item["message"])
+    finally:
+        hub.unsubscribe(channel, queue)
+
+
+async def multiplexed_ws_sender(websocket, queue: asyncio.Queue):
+    while True:
+        item = await queue.get()
+        await websocket.send_text(json.dumps(item))
+
+
+def _command_channels(command: dict) -> List[str]:
+    channels = command.get("channels")
+    if channels is None:
+        channels = [command.get("channel")]
+    return [str(channel) for channel in channels if channel is not None and not hub.is_reserved(str(channel))]
 
 
-async def events_ws_sender(websocket, channel: str):
-    async with broadcast.subscribe(channel=channel) as subscriber:
-        async for event in subscriber:
-            await websocket.send_text(event.message)
+def _last_seq(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@app.websocket("/ws/multiplex")
+async def multiplexed_websocket_endpoint(websocket: WebSocket):
+    # Одно соединение на много каналов: подписки управляются сообщениями
+    # {"action": "subscribe" | "unsubscribe" | "publish", "channel(s)": ...},
+    # все события отправляет одна задача с пометкой канала. Для докачки
+    # subscribe принимает "last_seq" или "last_seqs": {канал: номер}
+    # вместе с "epoch" или "epochs": {канал: epoch} из последнего полученного события.
+    await websocket.accept()
+    queue = hub.queue()
+    subscriptions = set()
+    sender = asyncio.ensure_future(multiplexed_ws_sender(websocket, queue))
+    try:
+        async for text in websocket.iter_text():
+            try:
+                command = json.loads(text)
+                action = command["action"]
+            except (ValueError, TypeError, KeyError):
+                hub.offer(queue, {"type": "error", "detail": "invalid command"})
+                continue
+            channels = _command_channels(command)
+            if action == "subscribe":
+                if len(subscriptions | set(channels)) > MAX_SUBSCRIPTIONS:
+                    hub.offer(queue, {"type": "error", "detail": "too many subscriptions"})
+                    continue
+                last_seqs = command.get("last_seqs") or {}
+                epochs = command.get("epochs") or {}
+                for channel in channels:
+                    if channel not in subscriptions:
+                        hub.subscribe(
+                            channel,
+                            queue,
+                            last_seq=_last_seq(last_seqs.get(channel, command.get("last_seq"))),
+                            epoch=epochs.get(channel, command.get("epoch")),
+                        )
+                        subscriptions.add(channel)
+                hub.offer(queue, {"type": "subscribed", "channels": channels})
+            elif action == "unsubscribe":
+                for channel in channels:
+                    if channel in subscriptions:
+                        hub.unsubscribe(channel, queue)
+                        subscriptions.discard(channel)
+                hub.offer(queue, {"type": "unsubscribed", "channels": channels})
+            elif action == "publish":
+                for channel in channels:
+                    await hub.publish(channel=channel, message=str(command.get("message", "")))
+            else:
+                hub.offer(queue, {"type": "error", "detail": "unknown action"})
+    finally:
+        sender.cancel()
+        for channel in subscriptions:
+            hub.unsubscribe(channel, queue)
+
+
+@app.websocket("/ingest/devices")
+async def device_ingest_endpoint(websocket: WebSocket, stats_repository=Depends(get_room_stats_repo)):
+    device_id = device_from_websocket(websocket)
+    if device_id is None:
+        await websocket.close(code=WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    await DeviceSession(websocket, device_id, stats_repository).run()
 
 
 @app.websocket("/{channel_id}")
-async def websocket_endpoint(websocket: WebSocket, channel_id: str):
+async def websocket_endpoint(
+        websocket: WebSocket,
+        channel_id: str,
+        last_seq: Optional[int] = None,
+        epoch: Optional[str] = None,
+):
+    if hub.is_reserved(channel_id):
+        await websocket.close(code=WS_1008_POLICY_VIOLATION)
+        return
     await websocket.accept()
     await run_until_first_complete(
         (events_ws_receiver, {"websocket": websocket, "channel": channel_id}),
-        (events_ws_sender, {"websocket": websocket, "channel": channel_id}),
+        (events_ws_sender, {"websocket": websocket, "channel": channel_id, "last_seq": last_seq, "epoch": epoch}),
     )
 
 
 if __name__ == "__main__":
+    import uvicorn
+
     uvicorn.run(app, host="0.0.0.0", port=8000)
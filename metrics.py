@@ -0,0 +1,42 @@
+from collections import defaultdict
+from typing import Dict, Tuple
+
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Metrics:
+    # Простейший реестр счётчиков и датчиков процесса, отдаётся на /metrics
+    # в текстовом формате Prometheus.
+    def __init__(self):
+        self.counters: Dict[_Key, float] = defaultdict(float)
+        self.gauges: Dict[_Key, float] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> _Key:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[self._key(name, labels)] += value
+
+    def set(self, name: str, value: float, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def get(self, name: str, **labels) -> float:
+        key = self._key(name, labels)
+        if key in self.gauges:
+            return self.gauges[key]
+        return self.counters.get(key, 0)
+
+    def render(self) -> str:
+        lines = []
+        for values in (self.counters, self.gauges):
+            for (name, labels), value in sorted(values.items()):
+                if labels:
+                    label_text = ",".join('{}="{}"'.format(k, v) for k, v in labels)
+                    lines.append("{}{{{}}} {}".format(name, label_text, value))
+                else:
+                    lines.append("{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
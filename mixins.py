@@ -1,8 +1,11 @@
 from abc import ABC
-from typing import List, Generic, TypeVar, Awaitable, Any
+from typing import List, Generic, TypeVar, Awaitable, Any, Optional, Iterable
 
 from databases import Database
-from sqlalchemy import Table
+from sqlalchemy import Table, func, select
+
+from admission import admission
+from shards import Fenced
 
 
 class ResolveNonExistingAttributesMixin:
@@ -32,3 +35,55 @@ class Repository(ResolveNonExistingAttributesMixin, Generic[T], ABC):
         return get_by_field_name
 
 
+class ShardRoutingMixin:
+    # Выбор БД для запроса. Без карты шардов всё идёт в self.database.
+    # Перед выбором — _locate, чтобы палаты и пациенты из других процессов нашлись в каталоге;
+    # запись — в транзакции, начатой с _guard (см. ShardMap.guard).
+    database: Database
+    shards: Optional[Any]
+
+    async def _locate(self, patients: Iterable[int] = (), rooms: Iterable[int] = ()):
+        if self.shards is not None:
+            await self.shards.locate(patients, rooms)
+
+    async def _guard(self, database: Database, rooms: Iterable[int] = (), patients: Iterable[int] = ()):
+        if self.shards is not None:
+            await self.shards.guard(database, rooms, patients)
+
+    async def _write_clinical(self, query, room_id: Optional[int] = None, patient_id: Optional[int] = None):
+        # Одна запись палаты или пациента на их шард. Забор на шарде — карта устарела
+        # (палату или пациента перенесли): перечитываем и пишем ещё раз.
+        room_ids = [room_id] if room_id is not None else []
+        patient_ids = [patient_id] if patient_id is not None else []
+        for attempt in range(2):
+            await self._locate(patient_ids, room_ids)
+            database = self._patient_db(patient_id) if patient_id is not None else self._room_db(room_id)
+            try:
+                async with admission.slot("clinical"), database.transaction():
+                    await self._guard(database, room_ids, patient_ids)
+                    await database.execute(query)
+                return
+            except Fenced:
+                if attempt or self.shards is None:
+                    raise
+                await self.shards.load()
+
+    async def _next_id(self, sequence: str) -> int:
+        # id, уникальный на всех шардах: из последовательности каталога.
+        database = self.database if self.shards is None else self.shards.catalog
+        return await database.fetch_val(select((func.nextval(sequence),)))
+
+    def _room_db(self, room_id: int) -> Database:
+        if self.shards is None:
+            return self.database
+        return self.shards.for_room(room_id)
+
+    def _patient_db(self, patient_id: int) -> Database:
+        if self.shards is None:
+            return self.database
+        return self.shards.for_patient(patient_id)
+
+    def _all_dbs(self) -> List[Database]:
+        if self.shards is None:
+            return [self.database]
+        return self.shards.databases
@@ -1,13 +1,54 @@
+import asyncio
 import datetime
+import logging
 import random
-from typing import Optional, List, Any
+import time
+from typing import Optional, List, Any, Dict, NamedTuple, Tuple
 
 from pydantic import BaseModel, Field
 from sqlalchemy import select, and_
-
+from sqlalchemy.dialects.postgresql import insert
+
+import rebalance
+from admission import Overloaded, admission
+from coalescing import coalesced
+from directory import WardDirectory
+from metrics import metrics
+from mixins import ShardRoutingMixin
 from schema import User, RoomDTO
+from shards import Fenced, ShardMap
+from spool import TRANSIENT_ERRORS, Spool
+from streaming_stats import StreamingStats
+from vital_types import VitalTypeCache, vital_type_cache
 from tables import users, rooms, users_rooms, stats_patient, room_params, stats_room, rozbory, jmenovani
 
+logger = logging.getLogger(__name__)
+
+# Сколько ждём запись показаний с ключом идемпотентности, прежде чем отложить их в спул.
+SPOOL_WRITE_TIMEOUT = 2.0
+# Запись не удалась, но её можно повторить позже: БД недоступна или палата переезжает.
+RETRYABLE_ERRORS = TRANSIENT_ERRORS + (Fenced,)
+
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _aware(value: datetime.datetime) -> datetime.datetime:
+    # Наивное время (старые записи спула) — локальное время сервера.
+    return value if value.tzinfo is not None else value.astimezone()
+
+
+class Reading(NamedTuple):
+    entity_id: int
+    type: str
+    value: float
+    # Время измерения на устройстве; без него — время приёма сервером.
+    saved_at: datetime.datetime
+    # Ключ идемпотентности: повтор с тем же (device_id, seq) не создаёт новую строку.
+    device_id: Optional[str] = None
+    seq: Optional[int] = None
+
 
 class UserOutDTO(BaseModel):
     id: int
@@ -26,11 +67,22 @@ class AnalOutDTO(BaseModel):
     saved_at: str
 
 
-class UsersRepository:
-    def __init__(self, database):
+class UsersRepository(ShardRoutingMixin):
+    def __init__(self, database, directory: Optional[WardDirectory] = None, shards: Optional[ShardMap] = None):
         self.database = database
+        self.directory = directory
+        self.shards = shards
 
     async def get_by_id(self, user_id: str) -> Optional[User]:
+        if self.directory is not None and self.directory.ready:
+            entry = self.directory.get_user(user_id)
+            if entry is not None:
+                return UserOutDTO(
+                    id=user_id,
+                    first_name=entry.first_name,
+                    second_name=entry.second_name,
+                    last_name=entry.last_name,
+                )
         query = users.select().where(users.c.id == user_id)
         result = await self.database.fetch_one(query)
         return UserOutDTO(
@@ -41,6 +93,10 @@ class UsersRepository:
         )
 
     async def get_by_login(self, login: str) -> Optional[User]:
+        if self.directory is not None and self.directory.ready:
+            user_id = self.directory.get_user_id_by_login(login)
+            if user_id is not None:
+                return await self.get_by_id(user_id)
         query = users.select().where(users.c.login == login)
         res = await self.database.fetch_one(query)
         return UserOutDTO(
@@ -59,19 +115,54 @@ class UsersRepository:
             last_name=ln,
             id=id
         )
-        await self.database.execute(query)
+        # users — справочник, он есть на каждом шарде.
+        await asyncio.gather(*(database.execute(query) for database in self._all_dbs()))
         query1 = (
             users_rooms.insert().values(
                 user_id=id,
                 room_id=room_id
             )
         )
-        await self.database.execute(query1)
-
-
-class RoomsRepository:
-    def __init__(self, database):
+        if self.shards is not None:
+            # Сначала каталог: по нему другие процессы найдут шард пациента.
+            await self.shards.place_patient(id, room_id)
+        # Палата может переезжать: пишем под её забором, как и перевод.
+        await self._write_clinical(query1, room_id=room_id)
+        if self.directory is not None:
+            await self.directory.notify({
+                "type": "user_created",
+                "id": id,
+                "login": lg,
+                "first_name": fn,
+                "second_name": sn,
+                "last_name": ln,
+                "room_id": room_id,
+            })
+
+    async def transfer(self, user_id: int, room_id: int):
+        await self._locate(patients=[user_id], rooms=[room_id])
+        source, target = self._patient_db(user_id), self._room_db(room_id)
+        if source is not target:
+            # Перевод в палату на другом шарде: история копируется, запись на старый шард
+            # закрывается забором, и только потом пациент переключается (см. rebalance.py).
+            # Старая копия удаляется в фоне, перевод её не ждёт.
+            await rebalance.move_patient(self.shards, user_id, room_id)
+        else:
+            async with target.transaction():
+                await self._guard(target, rooms=[room_id], patients=[user_id])
+                await target.execute(users_rooms.delete().where(users_rooms.c.user_id == user_id))
+                await target.execute(users_rooms.insert().values(user_id=user_id, room_id=room_id))
+            if self.shards is not None:
+                await self.shards.place_patient(user_id, room_id)
+        if self.directory is not None:
+            await self.directory.notify({"type": "user_moved", "user_id": user_id, "room_id": room_id})
+
+
+class RoomsRepository(ShardRoutingMixin):
+    def __init__(self, database, directory: Optional[WardDirectory] = None, shards: Optional[ShardMap] = None):
         self.database = database
+        self.directory = directory
+        self.shards = shards
 
     async def get_by_id(self, team_id: str) -> Optional[RoomDTO]:
         # query = rooms.select().where(teams.c.id == team_id)
@@ -82,23 +173,46 @@ class RoomsRepository:
         )
 
     async def get_all(self) -> Optional[List[RoomDTO]]:
+        if self.directory is not None and self.directory.ready:
+            return [
+                RoomDTO(name=name, identifier=room_id)
+                for room_id, name in sorted(self.directory.rooms.items())
+            ]
         query = rooms.select()
-        result = await self.database.fetch_all(query)
+        # Во время переноса палата есть на двух шардах сразу.
+        found = {}
+        async with admission.slot("dashboard"):
+            results = await asyncio.gather(*(database.fetch_all(query) for database in self._all_dbs()))
+        for result in results:
+            for v in result:
+                found[v.get("id")] = v.get("name")
         return [
             RoomDTO(
-                name=v.get("name"),
-                identifier=v.get("id")
+                name=name,
+                identifier=room_id
             )
-            for v in result
+            for room_id, name in sorted(found.items())
         ]
 
     async def get_users_by_room_id(self, room_id: int) -> List[User]:
+        if self.directory is not None and self.directory.ready:
+            result = []
+            for user_id in self.directory.get_patients(room_id):
+                entry = self.directory.get_user(user_id)
+                if entry is not None:
+                    result.append(User(
+                        id=user_id,
+                        login="",
+                        fullName=entry.second_name + " " + entry.first_name,
+                    ))
+            return result
         query = (
             select((users.c.id, users.c.first_name, users.c.second_name))
                 .select_from(users.join(users_rooms, users.c.id == users_rooms.c.user_id))
                 .where(users_rooms.c.room_id == room_id)
         )
-        result = await self.database.fetch_all(query)
+        await self._locate(rooms=[room_id])
+        result = await self._room_db(room_id).fetch_all(query)
         return [
             User(
                 id=v.get("id"),
@@ -109,10 +223,19 @@ class RoomsRepository:
         ]
 
     async def create(self, room_name: str):
-        query = rooms.insert().values(
-            name=room_name,
-        )
-        await self.database.execute(query)
+        if self.shards is None:
+            query = rooms.insert().values(
+                name=room_name,
+            ).returning(rooms.c.id)
+            room_id = await self.database.execute(query)
+        else:
+            # Назначение в каталоге — до создания палаты, чтобы её данные сразу шли на её шард.
+            room_id = await self._next_id("rooms_id_seq")
+            index = self.shards.least_loaded()
+            await self.shards.assign(room_id, index)
+            await self.shards.databases[index].execute(rooms.insert().values(id=room_id, name=room_name))
+        if self.directory is not None:
+            await self.directory.notify({"type": "room_created", "id": room_id, "name": room_name})
 
 
 class StatsType(BaseModel):
@@ -126,19 +249,75 @@ class ParamsSetted(BaseModel):
     value: float
 
 
-class StatsPatientRepo:
-    def __init__(self, database):
+class StatsPatientRepo(ShardRoutingMixin):
+    # Снаружи типы показателей — строки, в таблицах — smallint из vital_types.
+    # Показания пациента пишутся на шард его палаты, показания палаты — на её шард.
+    # Каждое обращение к БД держит место своего класса в admission: приём показаний —
+    # "ingestion", анализы, назначения и уставки — "clinical", графики и сводки — "dashboard".
+    def __init__(
+            self,
+            database,
+            types: VitalTypeCache = vital_type_cache,
+            spool: Optional[Spool] = None,
+            shards: Optional[ShardMap] = None,
+            stats: Optional[StreamingStats] = None,
+    ):
         self.database = database
+        self.types = types
+        self.spool = spool
+        self.shards = shards
+        self.stats = stats
+
+    async def _resolve_rows(self, entity: str, values: List[Reading]):
+        type_ids = {}
+        for type_ in {v.type for v in values}:
+            type_ids[type_] = await self.types.resolve(self.database, type_)
+        return [
+            {
+                entity: v.entity_id, "type_id": type_ids[v.type], "value": v.value, "saved_at": v.saved_at,
+                "device_id": v.device_id, "seq": v.seq,
+            }
+            for v in values
+        ]
 
+    async def _insert_readings(self, database, table, entity: str, values: List[Reading]) -> List[Reading]:
+        # Одна вставка на пачку; уже записанные показания (повтор после обрыва связи
+        # или повторная выгрузка спула) пропускаются по уникальному (device_id, seq).
+        # Возвращает те, что действительно записались.
+        query = insert(table).values(await self._resolve_rows(entity, values)).on_conflict_do_nothing(
+            index_elements=[table.c.device_id, table.c.seq],
+            index_where=table.c.device_id.isnot(None),
+        )
+        if all(v.device_id is None for v in values):
+            await database.execute(query)
+            return values
+        rows = await database.fetch_all(query.returning(table.c.device_id, table.c.seq))
+        inserted = {(row.get("device_id"), row.get("seq")) for row in rows}
+        result = []
+        for v in values:
+            if v.device_id is None or v.seq is None:
+                result.append(v)
+            elif (v.device_id, v.seq) in inserted:
+                # Один и тот же ключ дважды в пачке записан один раз.
+                inserted.discard((v.device_id, v.seq))
+                result.append(v)
+        return result
+
+    @coalesced()
     async def get_n_last_values(self, patient_id: int, type_: str, count: int = 10):
+        type_id = await self.types.find(self.database, type_)
+        if type_id is None:
+            return []
         query = (
             select((stats_patient.c.value, stats_patient.c.saved_at))
                 .select_from(stats_patient)
-                .where(and_(stats_patient.c.user_id == patient_id, stats_patient.c.type == type_))
+                .where(and_(stats_patient.c.user_id == patient_id, stats_patient.c.type_id == type_id))
                 .order_by(stats_patient.c.saved_at.desc())
                 .limit(count)
         )
-        result = await self.database.fetch_all(query)
+        await self._locate(patients=[patient_id])
+        async with admission.slot("dashboard"):
+            result = await self._patient_db(patient_id).fetch_all(query)
         return [
             StatsType(
                 type=type_,
@@ -148,26 +327,40 @@ class StatsPatientRepo:
             for v in result
         ]
 
-    async def push_new_value(self, patient_id: int, type_: str, value: float):
-        query = (
-            stats_patient.insert().values(
-                user_id=patient_id,
-                type=type_,
-                value=value,
-                saved_at=datetime.datetime.now()
-            )
-        )
-        await self.database.execute(query)
-
+    async def push_new_value(
+            self,
+            patient_id: int,
+            type_: str,
+            value: float,
+            saved_at: Optional[datetime.datetime] = None,
+            device_id: Optional[str] = None,
+            seq: Optional[int] = None,
+    ):
+        await self.push_new_values([Reading(patient_id, type_, value, saved_at or utcnow(), device_id, seq)])
+
+    async def push_new_values(self, values: List[Reading]):
+        await self.push_batch(values, [])
+
+    async def _insert_patient_values(self, database, values: List[Reading]) -> List[Reading]:
+        if not values:
+            return []
+        return await self._insert_readings(database, stats_patient, "user_id", values)
+
+    @coalesced()
     async def get_n_last_values_room(self, room_id: int, type_: str, count: int = 10):
+        type_id = await self.types.find(self.database, type_)
+        if type_id is None:
+            return []
         query = (
             select((stats_room.c.value, stats_room.c.saved_at))
                 .select_from(stats_room)
-                .where(and_(stats_room.c.user_id == room_id, stats_room.c.type == type_))
+                .where(and_(stats_room.c.room_id == room_id, stats_room.c.type_id == type_id))
                 .order_by(stats_room.c.saved_at.desc())
                 .limit(count)
         )
-        result = await self.database.fetch_all(query)
+        await self._locate(rooms=[room_id])
+        async with admission.slot("dashboard"):
+            result = await self._room_db(room_id).fetch_all(query)
         return [
             StatsType(
                 type=type_,
@@ -177,63 +370,256 @@ class StatsPatientRepo:
             for v in result
         ]
 
-    async def push_new_value_room(self, room_id: int, type_: str, value: float):
-        query = (
-            stats_room.insert().values(
-                room_id=room_id,
-                type=type_,
-                value=value,
-                saved_at=datetime.datetime.now()
-            )
+    async def push_new_value_room(
+            self,
+            room_id: int,
+            type_: str,
+            value: float,
+            saved_at: Optional[datetime.datetime] = None,
+            device_id: Optional[str] = None,
+            seq: Optional[int] = None,
+    ):
+        await self.push_new_values_room([Reading(room_id, type_, value, saved_at or utcnow(), device_id, seq)])
+
+    async def push_new_values_room(self, values: List[Reading]):
+        await self.push_batch([], values)
+
+    async def _insert_room_values(self, database, values: List[Reading]) -> List[Reading]:
+        if not values:
+            return []
+        return await self._insert_readings(database, stats_room, "room_id", values)
+
+    def _invalidate_rooms(self, values: List[Reading]):
+        # Запоздавшее показание может попасть в середину серии: сбрасываем кэш только затронутых палат.
+        # Только после коммита: чтение, начатое до него, закэшировало бы серию без новых строк.
+        for room_id in {v.entity_id for v in values}:
+            self.get_stats_room.invalidate(room_id=room_id)
+
+    async def push_batch(self, patients: List[Reading], rooms: List[Reading], create_types: bool = True):
+        # Показания пациентов и палат одной пачки пишутся вместе: на каждом шарде одной
+        # транзакцией, чтобы после ошибки и повтора пачки не осталось уже записанной половины.
+        # create_types=False — для устройств: неизвестный тип не заводим, а отклоняем пачку.
+        if not patients and not rooms:
+            return
+        if not create_types:
+            for type_ in {v.type for v in patients} | {v.type for v in rooms}:
+                await self.types.resolve(self.database, type_, create=False)
+        if self.spool is not None and not self.spool.is_empty:
+            # Пока спул не выгружен, новые показания идут туда же, иначе серии перемешаются.
+            self._spool_values(patients, rooms)
+            return
+        await self._locate([v.entity_id for v in patients], [v.entity_id for v in rooms])
+        error = await self._push_groups(patients, rooms, retry_fenced=self.shards is not None)
+        if error is not None:
+            raise error
+
+    async def _push_groups(
+            self, patients: List[Reading], rooms: List[Reading], retry_fenced: bool,
+    ) -> Optional[BaseException]:
+        groups = self._group(patients, rooms)
+        # Шарды пишем параллельно; в спул уходят только пачки недоступных шардов.
+        results = await asyncio.gather(
+            *(self._write(database, group) for database, group in groups.items()),
+            return_exceptions=True,
         )
-        await self.database.execute(query)
+        error = None
+        fenced_patients, fenced_rooms = [], []
+        spooled_patients, spooled_rooms = [], []
+        for (group_patients, group_rooms), result in zip(groups.values(), results):
+            if isinstance(result, Fenced) and retry_fenced:
+                fenced_patients += group_patients
+                fenced_rooms += group_rooms
+            elif isinstance(result, (Overloaded,) + RETRYABLE_ERRORS) and self.spool is not None:
+                spooled_patients += group_patients
+                spooled_rooms += group_rooms
+            elif isinstance(result, BaseException):
+                error = error or result
+        self._spool_values(spooled_patients, spooled_rooms)
+        if fenced_patients or fenced_rooms:
+            # Палату или пациента перенесли на другой шард: перечитываем карту и пишем туда.
+            await self.shards.load()
+            error = error or await self._push_groups(fenced_patients, fenced_rooms, retry_fenced=False)
+        return error
+
+    def _group(self, patients: List[Reading], rooms: List[Reading]) -> Dict[Any, Tuple[List[Reading], List[Reading]]]:
+        groups = {}
+        for v in patients:
+            groups.setdefault(self._patient_db(v.entity_id), ([], []))[0].append(v)
+        for v in rooms:
+            groups.setdefault(self._room_db(v.entity_id), ([], []))[1].append(v)
+        return groups
+
+    async def _write(self, database, group: Tuple[List[Reading], List[Reading]]):
+        patients, rooms = group
+        # Отменённый по таймауту INSERT мог успеть закоммититься. Повтор из спула безопасен
+        # только для показаний с (device_id, seq), поэтому остальные ждут БД без таймаута
+        # и в спул уходят лишь при явной ошибке соединения.
+        idempotent = all(v.device_id is not None and v.seq is not None for v in patients + rooms)
+        timeout = SPOOL_WRITE_TIMEOUT if self.spool is not None and idempotent else None
+        async with admission.slot("ingestion"):
+            inserted = await asyncio.wait_for(self._insert_batch(database, patients, rooms), timeout=timeout)
+        self._invalidate_rooms(inserted[1])
+        self._observe("patient", inserted[0])
+        self._observe("room", inserted[1])
+
+    async def _insert_batch(self, database, patients: List[Reading], rooms: List[Reading]):
+        async with database.transaction():
+            await self._guard(database, [v.entity_id for v in rooms], [v.entity_id for v in patients])
+            return (
+                await self._insert_patient_values(database, patients),
+                await self._insert_room_values(database, rooms),
+            )
 
+    def _observe(self, kind: str, values: List[Reading]):
+        # Статистика считает только записанное: повторы и откаченное в неё не попадают.
+        if self.stats is not None:
+            self.stats.observe(kind, values)
+
+    def _spool_values(self, patients: List[Reading], rooms: List[Reading]):
+        # Одной записью спула: при SpoolFull в спуле не остаётся половины пачки.
+        if not patients and not rooms:
+            return
+        appended_at = time.time()
+        self.spool.append([
+            {
+                "k": kind, "e": v.entity_id, "t": v.type, "v": v.value, "s": v.saved_at.isoformat(),
+                "d": v.device_id, "q": v.seq, "a": appended_at,
+            }
+            for kind, values in (("patient", patients), ("room", rooms))
+            for v in values
+        ])
+        metrics.inc("spool_appended_total", len(patients) + len(rooms))
+
+    async def push_spooled(self, records: List[dict]):
+        # Выгрузка спула: одна транзакция на пачку и шард, чтобы повтор после сбоя не задвоил её часть.
+        patients, rooms = [], []
+        for record in records:
+            row = Reading(
+                record["e"], record["t"], record["v"], _aware(datetime.datetime.fromisoformat(record["s"])),
+                record.get("d"), record.get("q"),
+            )
+            (patients if record["k"] == "patient" else rooms).append(row)
+        await self._locate([v.entity_id for v in patients], [v.entity_id for v in rooms])
+        await self._write_spooled(patients, rooms, retry_fenced=self.shards is not None)
+
+    async def _write_spooled(self, patients: List[Reading], rooms: List[Reading], retry_fenced: bool):
+        for database, (group_patients, group_rooms) in self._group(patients, rooms).items():
+            try:
+                async with admission.slot("ingestion"), database.transaction():
+                    await self._guard(
+                        database, [v.entity_id for v in group_rooms], [v.entity_id for v in group_patients],
+                    )
+                    inserted_patients = await self._insert_skipping_bad(
+                        database, self._insert_patient_values, group_patients,
+                    )
+                    inserted_rooms = await self._insert_skipping_bad(database, self._insert_room_values, group_rooms)
+            except Fenced:
+                if not retry_fenced:
+                    raise
+                await self.shards.load()
+                await self._write_spooled(group_patients, group_rooms, retry_fenced=False)
+                continue
+            self._invalidate_rooms(inserted_rooms)
+            self._observe("patient", inserted_patients)
+            self._observe("room", inserted_rooms)
+
+    async def _insert_skipping_bad(self, database, insert, values: List[Reading]) -> List[Reading]:
+        # Строки, которые БД не примет никогда (например, пациента уже удалили),
+        # не должны навсегда стопорить выгрузку.
+        if not values:
+            return []
+        try:
+            async with database.transaction():
+                return await insert(database, values)
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            logger.warning("spooled batch rejected, retrying row by row: %r", e)
+        inserted = []
+        for value in values:
+            try:
+                async with database.transaction():
+                    inserted.extend(await insert(database, [value]))
+            except TRANSIENT_ERRORS:
+                raise
+            except Exception as e:
+                logger.warning("dropping spooled row %r: %r", value, e)
+                metrics.inc("spool_dropped_total")
+        return inserted
+
+    @coalesced(ttl=0.5)
     async def get_stats_room(self, type_: str, room_id: int):
+        type_id = await self.types.find(self.database, type_)
+        if type_id is None:
+            return []
         query = (
-            stats_room
-                .select()
+            select((stats_room.c.value,))
+                .select_from(stats_room)
                 .where(
                     and_(
                         stats_room.c.room_id == room_id,
-                        stats_room.c.type == type_
+                        stats_room.c.type_id == type_id
                     )
                 )
                 .order_by(stats_room.c.saved_at.desc())
                 .limit(20)
         )
-        data = await self.database.fetch_all(query)
+        await self._locate(rooms=[room_id])
+        async with admission.slot("dashboard"):
+            data = await self._room_db(room_id).fetch_all(query)
         return [v.get("value") for v in data]
 
+    @coalesced(ttl=0.5)
     async def get_setted_params(self, room_id, type_: List[str] = None):
         if type_ is None:
             type_ = []
+        type_ids = await self.types.find_many(self.database, type_)
+        if not type_ids:
+            return {}
         query = (
-            select((room_params.c.value, room_params.c.type))
+            select((room_params.c.value, room_params.c.type_id))
                 .select_from(room_params)
-                .where(and_(room_params.c.room_id == room_id, room_params.c.type.in_(type_)))
+                .where(and_(room_params.c.room_id == room_id, room_params.c.type_id.in_(type_ids)))
                 .order_by(room_params.c.saved_at.desc())
         )
-        result = await self.database.fetch_all(query)
+        await self._locate(rooms=[room_id])
+        async with admission.slot("dashboard"):
+            result = await self._room_db(room_id).fetch_all(query)
         res = {}
         for i in result:
-            t = i.get("type")
+            t = self.types.name_of(i.get("type_id"))
             if t not in res:
                 res[t] = i.get("value")
         return res
 
-    async def set_params(self, room_id: int, type_: str, value: int):
+    async def set_params(
+            self,
+            room_id: int,
+            type_: str,
+            value: int,
+            saved_at: Optional[datetime.datetime] = None,
+            device_id: Optional[str] = None,
+            seq: Optional[int] = None,
+    ):
+        # Повтор с тем же (device_id, seq) не создаёт второй уставки.
         query = (
-            room_params.insert().values(
+            insert(room_params).values(
                 room_id=room_id,
-                type=type_,
+                type_id=await self.types.resolve(self.database, type_),
                 value=value,
-                saved_at=datetime.datetime.now(),
+                saved_at=saved_at or utcnow(),
+                device_id=device_id,
+                seq=seq,
+            ).on_conflict_do_nothing(
+                index_elements=[room_params.c.device_id, room_params.c.seq],
+                index_where=room_params.c.device_id.isnot(None),
             )
         )
-
-        await self.database.execute(query)
+        await self._write_clinical(query, room_id=room_id)
+        self.get_setted_params.invalidate(room_id=room_id)
 
     # Я уже настолько преисполнился, что не буду выносить анализы и назначения в отдельные репозитории
+    @coalesced()
     async def get_anals(self, user_id: int, count: int = -1):
         query = (
             rozbory
@@ -242,7 +628,9 @@ class StatsPatientRepo:
                 .where(rozbory.c.user_id == user_id)
                 .order_by(rozbory.c.saved_at.desc())
         )
-        res = await self.database.fetch_all(query)
+        await self._locate(patients=[user_id])
+        async with admission.slot("clinical"):
+            res = await self._patient_db(user_id).fetch_all(query)
         return [
             AnalOutDTO(
                 id=v[rozbory.c.id],
@@ -259,15 +647,17 @@ class StatsPatientRepo:
     async def push_anal(self, author_id: int, user_id: int, text: str):
         query = (
             rozbory.insert().values(
+                id=await self._next_id("rozbory_id_seq"),
                 text=text,
                 author_id=author_id,
                 user_id=user_id,
-                saved_at=datetime.datetime.now(),
+                saved_at=utcnow(),
             )
         )
+        await self._write_clinical(query, patient_id=user_id)
+        self.get_anals.invalidate(user_id=user_id)
 
-        await self.database.execute(query)
-
+    @coalesced()
     async def get_jmenovani(self, user_id: int, count: int = -1):
         query = (
             jmenovani
@@ -276,7 +666,9 @@ class StatsPatientRepo:
                 .where(jmenovani.c.user_id == user_id)
                 .order_by(jmenovani.c.saved_at.desc())
         )
-        res = await self.database.fetch_all(query)
+        await self._locate(patients=[user_id])
+        async with admission.slot("clinical"):
+            res = await self._patient_db(user_id).fetch_all(query)
         return [
             AnalOutDTO(
                 id=v[jmenovani.c.id],
@@ -293,11 +685,12 @@ class StatsPatientRepo:
     async def push_jmenovani(self, author_id: int, user_id: int, text: str):
         query = (
             jmenovani.insert().values(
+                id=await self._next_id("jmenovani_id_seq"),
                 text=text,
                 author_id=author_id,
                 user_id=user_id,
-                saved_at=datetime.datetime.now(),
+                saved_at=utcnow(),
             )
         )
-
-        await self.database.execute(query)
+        await self._write_clinical(query, patient_id=user_id)
+        self.get_jmenovani.invalidate(user_id=user_id)
@@ -0,0 +1,210 @@
+import logging
+import time
+from typing import Optional, Sequence
+
+import sqlalchemy as sa
+from alembic import context, op
+
+logger = logging.getLogger("alembic.online")
+
+# Хелперы для миграций больших таблиц (stats_patient, stats_room, room_params).
+# В онлайн-режиме (alembic -x online=true upgrade expand@head) индексы строятся
+# CONCURRENTLY, а заполнение колонок идёт пачками в отдельных транзакциях,
+# так что вставка показаний не блокируется. Без флага (пустая БД, --sql)
+# делается то же самое обычными командами.
+
+
+def _x_argument(name: str, default: Optional[str] = None) -> Optional[str]:
+    return context.get_x_argument(as_dictionary=True).get(name, default)
+
+
+def is_online() -> bool:
+    return not context.is_offline_mode() and _x_argument("online", "false").lower() in ("1", "true", "yes")
+
+
+def create_index(name: str, table: str, columns: Sequence[str], unique: bool = False, where: Optional[str] = None):
+    # columns — SQL-выражения, например "saved_at DESC".
+    sql = "CREATE {unique}INDEX {concurrently}IF NOT EXISTS {name} ON {table} ({columns}){where}".format(
+        unique="UNIQUE " if unique else "",
+        concurrently="CONCURRENTLY " if is_online() else "",
+        name=name,
+        table=table,
+        columns=", ".join(columns),
+        where=" WHERE {}".format(where) if where else "",
+    )
+    if not is_online():
+        op.execute(sql)
+        return
+    with op.get_context().autocommit_block():
+        # Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс,
+        # который IF NOT EXISTS молча пропустит.
+        invalid = op.get_bind().execute(sa.text(
+            "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"
+        ), {"name": name}).first()
+        if invalid:
+            logger.info("dropping invalid index %s left by an interrupted build", name)
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS {}".format(name))
+        started = time.monotonic()
+        op.execute(sql)
+        logger.info("built index %s on %s in %.1fs", name, table, time.monotonic() - started)
+
+
+def drop_index(name: str):
+    if not is_online():
+        op.execute("DROP INDEX IF EXISTS {}".format(name))
+        return
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS {}".format(name))
+
+
+def _server_version() -> int:
+    return int(op.get_bind().execute(sa.text("SHOW server_version_num")).scalar())
+
+
+def _relation_pages(table: str) -> int:
+    return op.get_bind().execute(sa.text(
+        "SELECT pg_relation_size(:table) / current_setting('block_size')::int"
+    ), {"table": table}).scalar()
+
+
+def _page_range_condition() -> str:
+    # Условие "строка лежит на страницах [:first, :last)", по которому Postgres
+    # читает только эти страницы. Диапазоны ctid так умеет читать только PG14+
+    # (TID Range Scan); раньше — через ctid = ANY(...) со всеми возможными
+    # номерами строк на страницах (TID Scan).
+    if _server_version() >= 140000:
+        return "ctid >= format('(%s,0)', :first)::tid AND ctid < format('(%s,0)', :last)::tid"
+    return (
+        "ctid = ANY(ARRAY(SELECT format('(%s,%s)', page, line)::tid "
+        "FROM generate_series(:first, :last - 1) page, "
+        "generate_series(1, (current_setting('block_size')::int - 24) / 28) line))"
+    )
+
+
+def backfill(table: str, assignments: str, where: str, batch_pages: Optional[int] = None, pause: Optional[float] = None):
+    # UPDATE table SET assignments WHERE where — пачками по batch_pages страниц таблицы.
+    # Курсор — номер страницы: каждая пачка читает только свои страницы, а не
+    # таблицу с начала. Обновлённые строки, переехавшие на дальние страницы,
+    # where уже не пропустит, поэтому повторно не обновляются.
+    if not is_online():
+        op.execute("UPDATE {} SET {} WHERE {}".format(table, assignments, where))
+        return
+    batch_pages = batch_pages or int(_x_argument("batch_pages", "1000"))
+    pause = pause if pause is not None else float(_x_argument("batch_pause", "0.1"))
+    with op.get_context().autocommit_block():
+        statement = sa.text("UPDATE {table} SET {assignments} WHERE {pages} AND ({where})".format(
+            table=table, assignments=assignments, pages=_page_range_condition(), where=where,
+        ))
+        total = _relation_pages(table)
+        started = time.monotonic()
+        page = done = 0
+        while True:
+            if page >= total:
+                # Таблица могла вырасти, пока шёл проход.
+                total = _relation_pages(table)
+                if page >= total:
+                    break
+            last = min(page + batch_pages, total)
+            done += op.get_bind().execute(statement, {"first": page, "last": last}).rowcount
+            page = last
+            elapsed = time.monotonic() - started
+            logger.info(
+                "backfill %s: page %d of %d (%.1f%%), %d rows, %.0f rows/s",
+                table, page, total, 100.0 * page / total if total else 100.0, done,
+                done / elapsed if elapsed else 0,
+            )
+            if pause:
+                time.sleep(pause)
+    logger.info("backfill %s finished: %d rows", table, done)
+
+
+def _shadow(column: str) -> str:
+    return "{}__new".format(column)
+
+
+def _sync_function(table: str, column: str) -> str:
+    return "{}_{}_sync".format(table, column)
+
+
+def set_not_null(table: str, column: str):
+    # CHECK ... NOT VALID + VALIDATE не блокирует запись; начиная с PG12
+    # SET NOT NULL пользуется проверенным CHECK и не сканирует таблицу.
+    # На PG11 SET NOT NULL просканировал бы всю таблицу под ACCESS EXCLUSIVE,
+    # поэтому там остаётся проверенный CHECK — гарантия та же.
+    constraint = "{}_{}_not_null".format(table, column)
+    op.execute("ALTER TABLE {} ADD CONSTRAINT {} CHECK ({} IS NOT NULL) NOT VALID".format(table, constraint, column))
+    _validate(table, constraint)
+    if context.is_offline_mode() or _server_version() < 120000:
+        return
+    op.execute("ALTER TABLE {} ALTER COLUMN {} SET NOT NULL".format(table, column))
+    op.execute("ALTER TABLE {} DROP CONSTRAINT {}".format(table, constraint))
+
+
+def add_foreign_key(name: str, table: str, column: str, referent: str, referent_column: str = "id"):
+    op.execute("ALTER TABLE {} ADD CONSTRAINT {} FOREIGN KEY ({}) REFERENCES {} ({}) NOT VALID".format(
+        table, name, column, referent, referent_column,
+    ))
+    _validate(table, name)
+
+
+def _validate(table: str, constraint: str):
+    statement = "ALTER TABLE {} VALIDATE CONSTRAINT {}".format(table, constraint)
+    if not is_online():
+        op.execute(statement)
+        return
+    with op.get_context().autocommit_block():
+        op.execute(statement)
+
+
+def begin_column_swap(
+        table: str,
+        column: str,
+        new_type: str,
+        using: Optional[str] = None,
+        new_column: Optional[str] = None,
+        fill: bool = True,
+):
+    # Смена типа без переписывания таблицы под блокировкой: теневая колонка,
+    # триггер для новых записей, пачечное заполнение старых. Завершается
+    # finish_column_swap в следующей миграции или в этой же после backfill.
+    # using — шаблон преобразования, "{}" заменяется на исходную колонку.
+    # new_column — оставить теневую колонку под своим именем вместо исходного.
+    # fill=False — только триггер: удобно, когда таблицу и так перепишет
+    # следующий backfill (UPDATE вызовет триггер), чтобы не переписывать её дважды.
+    shadow = new_column or _shadow(column)
+    using = using or "{}::" + new_type
+    function = _sync_function(table, column)
+    op.execute("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}".format(table, shadow, new_type))
+    # Код, который уже пишет в новую колонку, оставляет исходную пустой — такие строки не трогаем.
+    op.execute(
+        "CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$ "
+        "BEGIN IF NEW.{column} IS NOT NULL THEN NEW.{shadow} := {using_new}; END IF; RETURN NEW; END "
+        "$$ LANGUAGE plpgsql".format(
+            function=function, column=column, shadow=shadow, using_new=using.format("NEW." + column),
+        )
+    )
+    op.execute("DROP TRIGGER IF EXISTS {function} ON {table}".format(function=function, table=table))
+    op.execute(
+        "CREATE TRIGGER {function} BEFORE INSERT OR UPDATE ON {table} "
+        "FOR EACH ROW EXECUTE PROCEDURE {function}()".format(function=function, table=table)
+    )
+    if not fill:
+        return
+    backfill(
+        table,
+        "{} = {}".format(shadow, using.format(column)),
+        "{} IS NULL AND {} IS NOT NULL".format(shadow, column),
+    )
+
+
+def finish_column_swap(table: str, column: str, new_column: Optional[str] = None, lock_timeout: str = "5s"):
+    # Короткая транзакция: только переименования и DROP, без переписывания данных.
+    # Индексы по старой колонке удаляются вместе с ней — пересоздать через create_index.
+    function = _sync_function(table, column)
+    op.execute("SET LOCAL lock_timeout = '{}'".format(lock_timeout))
+    op.execute("DROP TRIGGER IF EXISTS {function} ON {table}".format(function=function, table=table))
+    op.execute("DROP FUNCTION IF EXISTS {}()".format(function))
+    op.execute("ALTER TABLE {} DROP COLUMN {}".format(table, column))
+    if new_column is None:
+        op.execute("ALTER TABLE {} RENAME COLUMN {} TO {}".format(table, _shadow(column), column))
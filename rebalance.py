@@ -0,0 +1,321 @@
+import argparse
+import asyncio
+import logging
+import time
+from typing import List, Optional, Set, Tuple
+
+from databases import Database
+from sqlalchemy import Table, and_, func, literal_column, select
+from sqlalchemy.dialects.postgresql import insert
+
+from db import spawn
+from shards import FENCE_LOCK_SPACES, ShardMap, SHARD_MAP_RELOAD_SECONDS, shard_map
+from tables import (
+    jmenovani, patient_rooms, room_params, rooms, rozbory, shard_fences, stats_patient, stats_room, users,
+    users_rooms, vital_types,
+)
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 5000
+# Докопирование кругами, пока за круг набегает больше TAIL_ROWS строк; остаток — под забором.
+TAIL_ROWS = 1000
+MAX_ROUNDS = 10
+WAIT_INTERVAL = 0.1
+# Сколько ждём транзакции, пишущие в переносимые таблицы; дольше — перенос прерывается.
+WRITERS_TIMEOUT = 60.0
+# Сколько старый шард ещё хранит данные после переключения: за это время все процессы перечитают карту.
+GRACE_SECONDS = 2 * SHARD_MAP_RELOAD_SECONDS
+
+# Перенос палаты (или пациента) между шардами, пока в неё идут показания:
+#   1. палата и размещение пациентов создаются на новом шарде;
+#   2. история копируется по порядковому номеру вставки row_id
+#      кругами до водяного знака: каждый круг забирает то, что записалось за предыдущий;
+#   3. на старом шарде ставится забор: запись туда прекращается (ShardMap.guard),
+#      остаток докопируется, палата переназначается в каталоге. Процессы со старой
+#      картой получают Fenced, перечитывают карту и пишут уже на новый шард;
+#   4. через grace, когда старую карту уже никто не читает, данные удаляются со старого шарда.
+# Запуск: python rebalance.py move-room <room_id> <shard>
+
+_Part = Tuple[Table, object]
+
+_SEQUENCE_VALUE = "SELECT pg_sequence_last_value(pg_get_serial_sequence(:table, :column)::regclass)"
+# INSERT берёт RowExclusiveLock на таблицу раньше, чем номер из последовательности,
+# и держит его до конца транзакции.
+_WRITERS = (
+    "SELECT DISTINCT virtualtransaction FROM pg_locks "
+    "WHERE mode = 'RowExclusiveLock' AND pid <> pg_backend_pid() AND relation IN "
+    "(SELECT CAST(name AS regclass) FROM unnest(CAST(:tables AS text[])) AS name)"
+)
+_RUNNING = "SELECT count(*) FROM pg_locks WHERE virtualtransaction = ANY(CAST(:writers AS text[]))"
+
+
+class StalledWriters(Exception):
+    pass
+
+
+async def copy_rows(source: Database, target: Database, table: Table, condition,
+                    after: Optional[int] = None, until: Optional[int] = None,
+                    batch_size: int = BATCH_SIZE) -> int:
+    # Строки с номером вставки в (after, until], keyset по номеру. У строк, уже
+    # переезжавших с другого шарда, номера чужой последовательности и могут совпасть
+    # со своими, поэтому строки с номером на границе пачки забираются вместе.
+    key = table.c.row_id
+    if after is not None:
+        condition = and_(condition, key > after)
+    if until is not None:
+        condition = and_(condition, key <= until)
+    copied, last = 0, None
+    while True:
+        query = table.select().where(condition)
+        if last is not None:
+            query = query.where(key > last)
+        rows = await source.fetch_all(query.order_by(key).limit(batch_size))
+        if not rows:
+            return copied
+        last = rows[-1].get(key.name)
+        if len(rows) == batch_size:
+            rows = [row for row in rows if row.get(key.name) != last]
+            rows += await source.fetch_all(table.select().where(and_(condition, key == last)))
+        copied += await _insert_rows(target, table, rows)
+
+
+async def _insert_rows(target: Database, table: Table, rows) -> int:
+    if rows:
+        await target.execute(table.insert().values([dict(row) for row in rows]))
+    return len(rows)
+
+
+async def watermarks(database: Database, tables: Set[Table]) -> dict:
+    # Номер вставки, до которого в каждой таблице всё уже закоммичено или откачено.
+    # Номера до текущего могли взять только транзакции, которые уже пишут в эти таблицы, —
+    # дожидаемся их, но не дольше WRITERS_TIMEOUT: остальные транзакции БД перенос не держат.
+    result = {}
+    for table in tables:
+        value = await database.fetch_val(_SEQUENCE_VALUE, {"table": table.name, "column": "row_id"})
+        result[table] = value or 0
+    names = sorted(table.name for table in tables)
+    writers = [row.get("virtualtransaction") for row in await database.fetch_all(_WRITERS, {"tables": names})]
+    deadline = time.monotonic() + WRITERS_TIMEOUT
+    while writers and await database.fetch_val(_RUNNING, {"writers": writers}):
+        if time.monotonic() > deadline:
+            raise StalledWriters("transactions writing to {} did not finish in {}s".format(names, WRITERS_TIMEOUT))
+        await asyncio.sleep(WAIT_INTERVAL)
+    return result
+
+
+async def copy_history(source: Database, target: Database, parts: List[_Part]) -> List[Optional[int]]:
+    # Круги до водяного знака; возвращает, докуда скопирована каждая часть.
+    marks: List[Optional[int]] = [None] * len(parts)
+    for _ in range(MAX_ROUNDS):
+        limits = await watermarks(source, {table for table, _ in parts})
+        copied = 0
+        for index, (table, condition) in enumerate(parts):
+            copied += await copy_rows(source, target, table, condition, after=marks[index], until=limits[table])
+            marks[index] = limits[table]
+        logger.info("copied %d rows up to %s", copied, {table.name: mark for table, mark in limits.items()})
+        if copied < TAIL_ROWS:
+            break
+    return marks
+
+
+async def copy_tail(source: Database, target: Database, parts: List[_Part], marks: List[Optional[int]]) -> int:
+    # Только под забором: на источник по этим частям больше никто не пишет.
+    copied = 0
+    for (table, condition), mark in zip(parts, marks):
+        copied += await copy_rows(source, target, table, condition, after=mark)
+    return copied
+
+
+async def fence(database: Database, kind: str, entity_id: int):
+    # Exclusive-блокировка дожидается записей, уже взявших shared в ShardMap.guard;
+    # следующие записи увидят забор.
+    async with database.transaction():
+        await database.execute(select((func.pg_advisory_xact_lock(FENCE_LOCK_SPACES[kind], entity_id),)))
+        await database.execute(insert(shard_fences).values(kind=kind, entity_id=entity_id).on_conflict_do_nothing())
+
+
+async def unfence(database: Database, kind: str, entity_id: int):
+    await database.execute(
+        shard_fences.delete().where(and_(shard_fences.c.kind == kind, shard_fences.c.entity_id == entity_id))
+    )
+
+
+async def delete_rows(database: Database, table: Table, condition, batch_size: int = BATCH_SIZE):
+    # Пачками по ctid, чтобы не держать одну долгую транзакцию на большой таблице.
+    ctid = literal_column("ctid")
+    while True:
+        batch = select((ctid,)).select_from(table).where(condition).limit(batch_size)
+        query = table.delete().where(ctid.in_(batch)).returning(literal_column("1"))
+        if await database.execute(query) is None:
+            return
+
+
+def _patient_parts(patient_id: int) -> List[_Part]:
+    return [(table, table.c.user_id == patient_id) for table in (stats_patient, rozbory, jmenovani)]
+
+
+def _room_parts(room_id: int) -> List[_Part]:
+    return [(table, table.c.room_id == room_id) for table in (stats_room, room_params)]
+
+
+async def delete_patient(database: Database, patient_id: int):
+    for table, condition in _patient_parts(patient_id):
+        await delete_rows(database, table, condition)
+
+
+async def _patients_of(database: Database, room_id: int) -> Set[int]:
+    rows = await database.fetch_all(users_rooms.select().where(users_rooms.c.room_id == room_id))
+    return {row.get("user_id") for row in rows}
+
+
+async def sync_reference(shards: ShardMap):
+    # users и vital_types с каталога на остальные шарды (новый шард начинается с этого).
+    for table, key in ((vital_types, vital_types.c.id), (users, users.c.id)):
+        rows = [dict(row) for row in await shards.catalog.fetch_all(table.select())]
+        for start in range(0, len(rows), BATCH_SIZE):
+            chunk = rows[start:start + BATCH_SIZE]
+            query = insert(table).values(chunk).on_conflict_do_nothing(index_elements=[key])
+            await asyncio.gather(*(replica.execute(query) for replica in shards.replicas))
+
+
+async def sync_patients(shards: ShardMap):
+    # patient_rooms в каталоге по users_rooms всех шардов (миграция видит только шард 0).
+    placed = {}
+    for database in shards.databases:
+        for row in await database.fetch_all(users_rooms.select()):
+            placed[row.get("user_id")] = row.get("room_id")
+    rows = [{"user_id": user_id, "room_id": room_id} for user_id, room_id in placed.items()]
+    for start in range(0, len(rows), BATCH_SIZE):
+        query = insert(patient_rooms).values(rows[start:start + BATCH_SIZE])
+        query = query.on_conflict_do_update(
+            index_elements=[patient_rooms.c.user_id], set_={"room_id": query.excluded.room_id},
+        )
+        await shards.catalog.execute(query)
+
+
+async def sync_ids(shards: ShardMap):
+    # Последовательности id в каталоге — выше всех id на шардах: раньше шарды выдавали свои.
+    for table in (rooms, rozbory, jmenovani):
+        values = await shards.fan_out(lambda database: database.fetch_val(select((func.max(table.c.id),))))
+        top = max((value for value in values if value is not None), default=0)
+        await shards.catalog.execute(
+            "SELECT setval('{0}_id_seq', GREATEST(:top, (SELECT last_value FROM {0}_id_seq)))".format(table.name),
+            {"top": top},
+        )
+
+
+async def move_room(shards: ShardMap, room_id: int, target_index: int, grace: Optional[float] = None):
+    source, target = shards.for_room(room_id), shards.databases[target_index]
+    if source is target:
+        logger.info("room %s already on shard %s", room_id, target_index)
+        return
+    room = await source.fetch_one(rooms.select().where(rooms.c.id == room_id))
+    if room is None:
+        raise ValueError("room {} not found on its shard".format(room_id))
+    patients = await _patients_of(source, room_id)
+
+    # Повторный запуск после сбоя начинает с чистого листа на целевом шарде;
+    # заборы от прошлых переездов оттуда снимаем.
+    await delete_room_data(target, room_id, patients)
+    for kind, entity_id in [("room", room_id)] + [("patient", p) for p in patients]:
+        await unfence(target, kind, entity_id)
+    await target.execute(insert(rooms).values(dict(room)).on_conflict_do_nothing(index_elements=[rooms.c.id]))
+
+    # owners — чей каждый кусок: None у палаты, id у пациента.
+    parts = _room_parts(room_id)
+    owners: List[Optional[int]] = [None] * len(parts)
+    for patient_id in sorted(patients):
+        parts += _patient_parts(patient_id)
+        owners += [patient_id] * (len(parts) - len(owners))
+    marks = await copy_history(source, target, parts)
+
+    await fence(source, "room", room_id)
+    # Пока шло копирование, пациентов могли перевести в палату или из неё (на том же шарде).
+    current = await _patients_of(source, room_id)
+    for patient_id in sorted(current - patients):
+        await delete_patient(target, patient_id)
+        await unfence(target, "patient", patient_id)
+        parts += _patient_parts(patient_id)
+        marks += [None] * (len(parts) - len(owners))
+        owners += [patient_id] * (len(parts) - len(owners))
+    for patient_id in patients - current:
+        await delete_patient(target, patient_id)
+    keep = [index for index, owner in enumerate(owners) if owner is None or owner in current]
+    tail = await copy_tail(source, target, [parts[i] for i in keep], [marks[i] for i in keep])
+    await _insert_rows(target, users_rooms, [{"user_id": p, "room_id": room_id} for p in sorted(current)])
+    await shards.assign(room_id, target_index)
+    logger.info("room %s switched to shard %s, %d rows copied under the fence", room_id, target_index, tail)
+
+    # Процессы со старой картой ещё читают старый шард: удаляем, когда все её перечитают.
+    await asyncio.sleep(GRACE_SECONDS if grace is None else grace)
+    await delete_room_data(source, room_id, current)
+    logger.info("room %s moved to shard %s", room_id, target_index)
+
+
+async def move_patient(shards: ShardMap, patient_id: int, room_id: int, grace: Optional[float] = None) -> asyncio.Task:
+    # Перевод пациента в палату на другом шарде — тот же порядок, что и у палаты, но ждём
+    # только переключения: старую копию удаляет фоновая задача, её и возвращаем.
+    source, target = shards.for_patient(patient_id), shards.for_room(room_id)
+    await delete_patient(target, patient_id)
+    await unfence(target, "patient", patient_id)
+    parts = _patient_parts(patient_id)
+    marks = await copy_history(source, target, parts)
+
+    await fence(source, "patient", patient_id)
+    await copy_tail(source, target, parts, marks)
+    await target.execute(users_rooms.insert().values(user_id=patient_id, room_id=room_id))
+    await shards.place_patient(patient_id, room_id)
+    await source.execute(users_rooms.delete().where(users_rooms.c.user_id == patient_id))
+    return spawn(_delete_patient_later(source, patient_id, GRACE_SECONDS if grace is None else grace))
+
+
+async def _delete_patient_later(database: Database, patient_id: int, delay: float):
+    # Не успели (процесс остановили) — не страшно: на старом шарде пациент за забором,
+    # а повторный переезд туда сначала чистит целевой шард.
+    await asyncio.sleep(delay)
+    try:
+        await delete_patient(database, patient_id)
+    except Exception as e:
+        logger.warning("cleanup of patient %s on the old shard failed: %r", patient_id, e)
+
+
+async def delete_room_data(database: Database, room_id: int, patients: Set[int]):
+    for patient_id in patients:
+        await delete_patient(database, patient_id)
+    for table, condition in _room_parts(room_id):
+        await delete_rows(database, table, condition)
+    await delete_rows(database, users_rooms, users_rooms.c.room_id == room_id)
+    await database.execute(rooms.delete().where(rooms.c.id == room_id))
+
+
+async def _main(args):
+    await shard_map.catalog.connect()
+    await shard_map.connect()
+    try:
+        await shard_map.load()
+        if args.command == "sync-reference":
+            await sync_reference(shard_map)
+        elif args.command == "sync-patients":
+            await sync_patients(shard_map)
+        elif args.command == "sync-ids":
+            await sync_ids(shard_map)
+        else:
+            await move_room(shard_map, args.room_id, args.shard, grace=args.grace)
+    finally:
+        await shard_map.disconnect()
+        await shard_map.catalog.disconnect()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Перенос палат между шардами")
+    commands = parser.add_subparsers(dest="command", required=True)
+    move = commands.add_parser("move-room")
+    move.add_argument("room_id", type=int)
+    move.add_argument("shard", type=int)
+    move.add_argument("--grace", type=float, default=GRACE_SECONDS)
+    commands.add_parser("sync-reference")
+    commands.add_parser("sync-patients")
+    commands.add_parser("sync-ids")
+    asyncio.run(_main(parser.parse_args()))
@@ -1,5 +1,5 @@
 import enum
-from typing import Optional
+from typing import Dict, Optional
 
 from pydantic import BaseModel, Field
 
@@ -15,6 +15,28 @@ class RoomDTO(BaseModel):
     identifier: int
 
 
+class SeriesStatsDTO(BaseModel):
+    # count/mean/variance/min/max — за окно STATS_WINDOW_SECONDS, total_* — за всё время.
+    count: int
+    mean: Optional[float]
+    variance: float
+    total_count: int
+    total_mean: float
+    total_variance: float
+    ewma: float
+    min: Optional[float]
+    max: Optional[float]
+    last_value: float
+    last_at: str
+
+
+class RoomStatsDTO(BaseModel):
+    room_id: int
+    # Тип показателя -> статистика.
+    room: Dict[str, SeriesStatsDTO]
+    patients: Dict[int, Dict[str, SeriesStatsDTO]]
+
+
 class Categories(enum.Enum):
     begin = 0
     stop = 1
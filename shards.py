@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, TypeVar
+
+from databases import Database
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+from db import DB_POOL_MAX_SIZE, DB_POOL_MIN_SIZE, db
+from tables import patient_rooms, room_shards, shard_fences
+
+logger = logging.getLogger(__name__)
+
+# Дополнительные шарды через запятую; шард 0 — всегда DATABASE_URL.
+SHARD_DATABASE_URLS = [url.strip() for url in os.environ.get("SHARD_DATABASE_URLS", "").split(",") if url.strip()]
+SHARD_MAP_RELOAD_SECONDS = float(os.environ.get("SHARD_MAP_RELOAD_SECONDS", "5"))
+
+T = TypeVar("T")
+
+# Первый ключ pg_advisory_xact_lock_shared(int, int) для заборов палат и пациентов.
+FENCE_LOCK_SPACES = {"room": 7301, "patient": 7302}
+_LOCK_FENCES = (
+    "SELECT count(*) FROM (SELECT pg_advisory_xact_lock_shared(space, entity_id) "
+    "FROM unnest(CAST(:spaces AS int[]), CAST(:ids AS int[])) AS fence(space, entity_id)) AS locked"
+)
+
+
+class Fenced(Exception):
+    # Запись пришла на шард, с которого палата или пациент уезжает или уже уехал:
+    # карта шардов в процессе устарела, её надо перечитать и записать заново.
+    pass
+
+
+class ShardMap:
+    # Палата и всё, что к ней привязано (users_rooms, stats_room, room_params,
+    # а также показания, анализы и назначения её пациентов), живёт на одном шарде.
+    # Шард 0 — основная БД: в ней каталог (room_shards, patient_rooms), последовательность
+    # id палат и все палаты без назначения (данные, записанные до шардирования).
+    # users и vital_types — справочники, на которые ссылаются все таблицы,
+    # поэтому их копия есть на каждом шарде.
+    def __init__(self, databases: List[Database]):
+        self.databases = databases
+        self.assignments: Dict[int, int] = {}
+        self.patients: Dict[int, int] = {}
+        # Чего нет в каталоге, не ищем в нём снова до этого момента (time.monotonic()).
+        self._missing: Dict[tuple, float] = {}
+        # Список палат для least_loaded; выставляется при старте.
+        self.directory = None
+
+    @property
+    def catalog(self) -> Database:
+        return self.databases[0]
+
+    @property
+    def replicas(self) -> List[Database]:
+        return self.databases[1:]
+
+    def index_of_room(self, room_id: int) -> int:
+        return self.assignments.get(room_id, 0)
+
+    def for_room(self, room_id: int) -> Database:
+        return self.databases[self.index_of_room(room_id)]
+
+    def for_patient(self, patient_id: int) -> Database:
+        # Пациент без палаты — на каталоге.
+        room_id = self.patients.get(patient_id)
+        if room_id is None:
+            return self.catalog
+        return self.for_room(room_id)
+
+    def least_loaded(self) -> int:
+        counts = [0] * len(self.databases)
+        room_ids = set(self.assignments)
+        if self.directory is not None:
+            room_ids |= set(self.directory.rooms)
+        for room_id in room_ids:
+            counts[self.index_of_room(room_id)] += 1
+        return counts.index(min(counts))
+
+    async def locate(self, patients: Iterable[int] = (), rooms: Iterable[int] = ()):
+        # Палаты и пациенты, созданные другим процессом после последнего load, ищем
+        # в каталоге сразу, а не ждём перечитывания карты: иначе их данные ушли бы на шард 0.
+        # Нет в каталоге — значит, законно на шарде 0 (палата без назначения, пациент без палаты).
+        now = time.monotonic()
+        patients = set(patients)
+        unknown = [
+            p for p in patients
+            if p not in self.patients and self._missing.get(("patient", p), 0.0) <= now
+        ]
+        if unknown:
+            rows = await self.catalog.fetch_all(patient_rooms.select().where(patient_rooms.c.user_id.in_(unknown)))
+            for row in rows:
+                self.patients[row.get("user_id")] = row.get("room_id")
+            self._remember_missing("patient", unknown, now)
+        rooms = set(rooms) | {self.patients[p] for p in patients if p in self.patients}
+        unknown = [
+            r for r in rooms
+            if r not in self.assignments and self._missing.get(("room", r), 0.0) <= now
+        ]
+        if unknown:
+            rows = await self.catalog.fetch_all(room_shards.select().where(room_shards.c.room_id.in_(unknown)))
+            for row in rows:
+                self.assignments[row.get("room_id")] = row.get("shard")
+            self._remember_missing("room", unknown, now)
+
+    def _remember_missing(self, kind: str, ids: List[int], now: float):
+        known = self.patients if kind == "patient" else self.assignments
+        if len(self._missing) >= 100000:
+            self._missing.clear()
+        for entity_id in ids:
+            if entity_id not in known:
+                self._missing[(kind, entity_id)] = now + SHARD_MAP_RELOAD_SECONDS
+
+    async def guard(self, database: Database, rooms: Iterable[int] = (), patients: Iterable[int] = ()):
+        # Вызывается в начале транзакции записи. Shared-блокировка держится до её конца,
+        # поэтому rebalance.py, ставя забор под exclusive-блокировкой, дожидается
+        # начатых записей, а все следующие видят забор и получают Fenced.
+        # Пациент переезжает и вместе со своей палатой, поэтому блокируем и её.
+        patients = set(patients)
+        rooms = set(rooms) | {self.patients[p] for p in patients if p in self.patients}
+        keys = {("room", r) for r in rooms} | {("patient", p) for p in patients}
+        if not keys:
+            return
+        await database.fetch_val(_LOCK_FENCES, {
+            "spaces": [FENCE_LOCK_SPACES[kind] for kind, _ in keys],
+            "ids": [entity_id for _, entity_id in keys],
+        })
+        query = (
+            select((shard_fences.c.kind, shard_fences.c.entity_id))
+                .where(shard_fences.c.entity_id.in_({entity_id for _, entity_id in keys}))
+        )
+        fenced = [
+            "{} {}".format(row.get("kind"), row.get("entity_id"))
+            for row in await database.fetch_all(query)
+            if (row.get("kind"), row.get("entity_id")) in keys
+        ]
+        if fenced:
+            raise Fenced(", ".join(fenced))
+
+    async def connect(self):
+        await asyncio.gather(*(database.connect() for database in self.replicas))
+
+    async def disconnect(self):
+        await asyncio.gather(*(database.disconnect() for database in self.replicas))
+
+    async def load(self):
+        rooms_rows, patients_rows = await asyncio.gather(
+            self.catalog.fetch_all(room_shards.select()),
+            self.catalog.fetch_all(patient_rooms.select()),
+        )
+        self.assignments = {row.get("room_id"): row.get("shard") for row in rooms_rows}
+        self.patients = {row.get("user_id"): row.get("room_id") for row in patients_rows}
+        self._missing = {}
+
+    async def reload_periodically(self, interval: float):
+        # Так процессы узнают о переносах; до этого их удерживают заборы (guard).
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.load()
+            except Exception as e:
+                logger.warning("shard map reload failed: %r", e)
+
+    async def assign(self, room_id: int, index: int):
+        query = insert(room_shards).values(room_id=room_id, shard=index)
+        query = query.on_conflict_do_update(index_elements=[room_shards.c.room_id], set_={"shard": index})
+        await self.catalog.execute(query)
+        self.assignments[room_id] = index
+
+    async def place_patient(self, patient_id: int, room_id: int):
+        query = insert(patient_rooms).values(user_id=patient_id, room_id=room_id)
+        query = query.on_conflict_do_update(index_elements=[patient_rooms.c.user_id], set_={"room_id": room_id})
+        await self.catalog.execute(query)
+        self.patients[patient_id] = room_id
+
+    async def fan_out(self, call: Callable[[Database], Awaitable[T]]) -> List[T]:
+        return list(await asyncio.gather(*(call(database) for database in self.databases)))
+
+    async def replicate(self, query):
+        # Запись в справочник на всех шардах.
+        await self.fan_out(lambda database: database.execute(query))
+
+
+shard_map = ShardMap([db] + [
+    Database(url, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE)
+    for url in SHARD_DATABASE_URLS
+])
@@ -0,0 +1,291 @@
+import asyncio
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import asyncpg
+
+from db import BASE_DIR
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, при которых показания не теряем, а откладываем в спул:
+# БД недоступна, перезапускается или не ответила вовремя.
+TRANSIENT_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.TooManyConnectionsError,
+    asyncpg.InterfaceError,
+)
+
+SPOOL_PATH = os.environ.get("SPOOL_PATH", os.path.join(BASE_DIR, "spool", "vitals.spool"))
+# Сколько файлов спула пробуем, если основной занят другим воркером.
+MAX_SPOOL_FILES = 64
+
+_MAGIC = 0x53504F4C
+# magic, epoch, длина тела, crc32(epoch + тело)
+_HEADER = struct.Struct("<IIII")
+
+
+class SpoolFull(Exception):
+    pass
+
+
+class Spool:
+    # Локальный журнал показаний в файле, отображённом в память. Только дописывание;
+    # каждая запись — пачка показаний с контрольной суммой, поэтому пачка попадает
+    # в журнал целиком или никак, а оборванный хвост после падения просто отбрасывается.
+    # Прочитанная позиция и номер эпохи лежат рядом в .offset: после полной выгрузки
+    # журнал начинается с нуля в новой эпохе, и записи старой эпохи, оставшиеся в файле,
+    # при восстановлении не подхватываются. Если выгрузка не догоняет запись, но
+    # прочитано уже больше compact_size, невыгруженный хвост переносится в начало файла.
+    def __init__(
+            self,
+            path: str,
+            initial_size: int = 16 * 2 ** 20,
+            max_size: int = 2 ** 30,
+            sync: bool = False,
+            compact_size: Optional[int] = None,
+    ):
+        self.path = path
+        self.initial_size = initial_size
+        self.max_size = max_size
+        self.sync = sync
+        self.compact_size = compact_size if compact_size is not None else initial_size // 4
+        self.epoch = 1
+        self.read_offset = 0
+        self.write_offset = 0
+        self.pending = 0
+        self._fd: Optional[int] = None
+        self._map: Optional[mmap.mmap] = None
+        self._dirty = False
+
+    @property
+    def is_empty(self) -> bool:
+        return self.pending == 0
+
+    @property
+    def pending_bytes(self) -> int:
+        return self.write_offset - self.read_offset
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # Файл принадлежит одному процессу: занятый другим воркером пропускаем.
+        # Перезапущенный воркер подберёт любой свободный файл, в том числе
+        # недовыгруженный хвост умершего соседа.
+        base = self.path
+        for index in range(MAX_SPOOL_FILES):
+            path = base if index == 0 else "{}.{}".format(base, index)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            self.path, self._fd = path, fd
+            break
+        else:
+            raise SpoolFull("no free spool file next to {}".format(base))
+        size = os.fstat(self._fd).st_size
+        if size < self.initial_size:
+            os.ftruncate(self._fd, self.initial_size)
+            size = self.initial_size
+        self._map = mmap.mmap(self._fd, size)
+        self.epoch, self.read_offset = self._load_offsets()
+        self.write_offset, self.pending = self.read_offset, 0
+        while True:
+            record = self._record_at(self.write_offset)
+            if record is None:
+                break
+            self.write_offset = record[1]
+            self.pending += len(self._decode(record[0]))
+        if self.pending:
+            logger.info("spool %s recovered %d records", self.path, self.pending)
+
+    def close(self):
+        if self._map is not None:
+            self.flush()
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def append(self, records: List[dict]):
+        # Одна запись журнала на пачку: SpoolFull или падение не оставляют её половину.
+        if not records:
+            return
+        payload = json.dumps(records, separators=(",", ":")).encode()
+        end = self.write_offset + _HEADER.size + len(payload)
+        self._ensure(end)
+        self._write_record(self.write_offset, payload, self.epoch)
+        self.write_offset = end
+        self.pending += len(records)
+        self._dirty = True
+        if self.sync:
+            self.flush()
+
+    def read(self, limit: int) -> Tuple[List[dict], int]:
+        records, offset = [], self.read_offset
+        while len(records) < limit and offset < self.write_offset:
+            record = self._record_at(offset)
+            if record is None:
+                break
+            records.extend(self._decode(record[0]))
+            offset = record[1]
+        return records, offset
+
+    def commit(self, offset: int, count: int):
+        # Вызывает только выгрузка, между read и commit: других незакоммиченных чтений нет,
+        # поэтому хвост можно переносить.
+        self.read_offset = offset
+        self.pending -= count
+        if self.read_offset >= self.write_offset or (
+                self.read_offset >= self.compact_size and self.read_offset >= self.pending_bytes):
+            self._compact()
+        self._save_offsets()
+
+    def flush(self):
+        if self._dirty:
+            self._map.flush()
+            self._dirty = False
+
+    def oldest_age(self) -> float:
+        if self.is_empty:
+            return 0.0
+        record = self._record_at(self.read_offset)
+        if record is None:
+            return 0.0
+        return max(time.time() - self._decode(record[0])[0].get("a", time.time()), 0.0)
+
+    def _compact(self):
+        # Невыгруженный хвост переписывается в начало файла в новой эпохе. Он не длиннее
+        # прочитанного, поэтому копия не задевает оригинал: до сохранения .offset
+        # после падения читается старая эпоха со старой позиции, после — новая с нуля.
+        epoch = self.epoch + 1
+        offset, target = self.read_offset, 0
+        while offset < self.write_offset:
+            payload, offset = self._record_at(offset)
+            self._write_record(target, payload, epoch)
+            target += _HEADER.size + len(payload)
+        self.epoch, self.read_offset, self.write_offset = epoch, 0, target
+        self._dirty = True
+        metrics.inc("spool_compactions_total")
+
+    def _write_record(self, offset: int, payload: bytes, epoch: int):
+        end = offset + _HEADER.size + len(payload)
+        # Сначала тело, потом заголовок: запись без заголовка при восстановлении не видна.
+        self._map[offset + _HEADER.size:end] = payload
+        self._map[offset:offset + _HEADER.size] = _HEADER.pack(_MAGIC, epoch, len(payload), self._crc(payload, epoch))
+
+    @staticmethod
+    def _decode(payload: bytes) -> List[dict]:
+        # Старые журналы хранили по одному показанию на запись.
+        records = json.loads(payload)
+        return records if isinstance(records, list) else [records]
+
+    def _crc(self, payload: bytes, epoch: Optional[int] = None) -> int:
+        epoch = self.epoch if epoch is None else epoch
+        return zlib.crc32(payload, zlib.crc32(struct.pack("<I", epoch)))
+
+    def _record_at(self, offset: int) -> Optional[Tuple[bytes, int]]:
+        size = len(self._map)
+        if offset + _HEADER.size > size:
+            return None
+        magic, epoch, length, crc = _HEADER.unpack_from(self._map, offset)
+        end = offset + _HEADER.size + length
+        if magic != _MAGIC or epoch != self.epoch or end > size:
+            return None
+        payload = self._map[offset + _HEADER.size:end]
+        if self._crc(payload) != crc:
+            return None
+        return payload, end
+
+    def _ensure(self, end: int):
+        size = len(self._map)
+        if end <= size:
+            return
+        new_size = max(size * 2, end)
+        if new_size > self.max_size:
+            raise SpoolFull(self.path)
+        self._map.flush()
+        self._map.close()
+        os.ftruncate(self._fd, new_size)
+        self._map = mmap.mmap(self._fd, new_size)
+
+    def _offsets_path(self) -> str:
+        return self.path + ".offset"
+
+    def _load_offsets(self) -> Tuple[int, int]:
+        try:
+            with open(self._offsets_path()) as f:
+                state = json.load(f)
+            return int(state["epoch"]), int(state["read"])
+        except (OSError, ValueError, KeyError):
+            return 1, 0
+
+    def _save_offsets(self):
+        # Позицию сохраняем только после записи в БД: при падении между ними
+        # часть пачки выгрузится повторно, но не потеряется.
+        self.flush()
+        tmp = self._offsets_path() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"epoch": self.epoch, "read": self.read_offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._offsets_path())
+
+
+class SpoolDrainer:
+    # Фоновая выгрузка спула в БД пачками, в порядке записи.
+    def __init__(
+            self,
+            spool: Spool,
+            write: Callable[[List[dict]], Awaitable[None]],
+            batch_size: int = 5000,
+            idle_interval: float = 1.0,
+            max_backoff: float = 30.0,
+    ):
+        self.spool = spool
+        self.write = write
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self.max_backoff = max_backoff
+
+    def report(self):
+        metrics.set("spool_pending_records", self.spool.pending)
+        metrics.set("spool_pending_bytes", self.spool.pending_bytes)
+        metrics.set("spool_oldest_age_seconds", self.spool.oldest_age())
+
+    async def run(self):
+        backoff = self.idle_interval
+        while True:
+            self.spool.flush()
+            self.report()
+            if self.spool.is_empty:
+                await asyncio.sleep(self.idle_interval)
+                continue
+            records, offset = self.spool.read(self.batch_size)
+            try:
+                await self.write(records)
+            except Exception as e:
+                logger.warning("spool drain failed, retrying in %.1fs: %r", backoff, e)
+                metrics.inc("spool_drain_failures_total")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            backoff = self.idle_interval
+            self.spool.commit(offset, len(records))
+            metrics.inc("spool_drained_total", len(records))
+
+
+spool = Spool(SPOOL_PATH, sync=os.environ.get("SPOOL_SYNC") == "1") if SPOOL_PATH else None
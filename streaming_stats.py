@@ -0,0 +1,306 @@
+import asyncio
+import datetime
+import json
+import logging
+import math
+import os
+from collections import deque
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from databases import Database
+from sqlalchemy.dialects.postgresql import insert
+
+from admission import Overloaded, admission
+from metrics import metrics
+from tables import series_stats
+from vital_types import VitalTypeCache, vital_type_cache
+
+logger = logging.getLogger(__name__)
+
+# Окно для min/max и постоянная времени EWMA, в секундах.
+STATS_WINDOW_SECONDS = float(os.environ.get("STATS_WINDOW_SECONDS", "3600"))
+STATS_EWMA_TAU_SECONDS = float(os.environ.get("STATS_EWMA_TAU_SECONDS", "300"))
+STATS_CHECKPOINT_SECONDS = float(os.environ.get("STATS_CHECKPOINT_SECONDS", "30"))
+# На сколько корзин делится окно для count/mean/variance: граница окна точна до корзины.
+STATS_WINDOW_BUCKETS = int(os.environ.get("STATS_WINDOW_BUCKETS", "60"))
+CHECKPOINT_BATCH_SIZE = 1000
+
+_SeriesKey = Tuple[str, int, str]
+
+
+class WindowExtreme:
+    # Максимум за скользящее окно: монотонная очередь, время растёт, значение убывает,
+    # в голове — ответ. Минимум — то же самое со значениями с обратным знаком.
+    def __init__(self, sign: int):
+        self.sign = sign
+        self.items = deque()
+
+    @property
+    def value(self) -> Optional[float]:
+        return self.items[0][1] * self.sign if self.items else None
+
+    def push(self, at: float, value: float):
+        value *= self.sign
+        items = self.items
+        if not items or at >= items[-1][0]:
+            while items and items[-1][1] <= value:
+                items.pop()
+            items.append((at, value))
+            return
+        # Запоздавшее значение: ищем место по времени с хвоста, очередь обычно короткая.
+        index = len(items)
+        while index > 0 and items[index - 1][0] > at:
+            index -= 1
+        if items[index][1] >= value:
+            # Позже в окне уже есть значение не меньше — это никогда не станет ответом.
+            return
+        items.insert(index, (at, value))
+        while index > 0 and items[index - 1][1] <= value:
+            del items[index - 1]
+            index -= 1
+
+    def expire(self, before: float):
+        while self.items and self.items[0][0] < before:
+            self.items.popleft()
+
+    def dump(self) -> str:
+        return json.dumps([[at, value * self.sign] for at, value in self.items])
+
+    @classmethod
+    def restore(cls, sign: int, dumped: Optional[str]) -> "WindowExtreme":
+        window = cls(sign)
+        for at, value in json.loads(dumped or "[]"):
+            window.items.append((at, value * sign))
+        return window
+
+
+class WindowMoments:
+    # count/mean/m2 за скользящее окно: кольцо корзин по времени измерения, в каждой
+    # свой Уэлфорд, при чтении корзины сливаются (формула Чана). Самая старая корзина
+    # учитывается целиком, пока не выйдет из окна вся.
+    def __init__(self, width: float):
+        self.width = width
+        # [начало корзины, count, mean, m2] по возрастанию начала.
+        self.buckets = deque()
+
+    def push(self, at: float, value: float):
+        start = math.floor(at / self.width) * self.width
+        buckets = self.buckets
+        index = len(buckets)
+        while index > 0 and buckets[index - 1][0] > start:
+            index -= 1
+        if index > 0 and buckets[index - 1][0] == start:
+            bucket = buckets[index - 1]
+        else:
+            bucket = [start, 0, 0.0, 0.0]
+            buckets.insert(index, bucket)
+        bucket[1] += 1
+        delta = value - bucket[2]
+        bucket[2] += delta / bucket[1]
+        bucket[3] += delta * (value - bucket[2])
+
+    def expire(self, before: float):
+        while self.buckets and self.buckets[0][0] + self.width <= before:
+            self.buckets.popleft()
+
+    def merged(self) -> Tuple[int, float, float]:
+        count, mean, m2 = 0, 0.0, 0.0
+        for _, n, bucket_mean, bucket_m2 in self.buckets:
+            total = count + n
+            delta = bucket_mean - mean
+            mean += delta * n / total
+            m2 += bucket_m2 + delta * delta * count * n / total
+            count = total
+        return count, mean, m2
+
+    def dump(self) -> str:
+        return json.dumps(list(self.buckets))
+
+    @classmethod
+    def restore(cls, width: float, dumped: Optional[str]) -> "WindowMoments":
+        moments = cls(width)
+        moments.buckets.extend(list(bucket) for bucket in json.loads(dumped or "[]"))
+        return moments
+
+
+class SeriesStats:
+    # Накопители одной серии (пациент или палата, тип показателя), каждое обновление O(1):
+    #   moments — count/mean/variance за последние STATS_WINDOW_SECONDS (корзины);
+    #   count/mean/m2 — то же за всё время, Уэлфорд без хранения значений;
+    #   ewma — экспоненциальное среднее с постоянной времени tau по времени измерения;
+    #   window_min/window_max — экстремумы за то же окно.
+    def __init__(self, window: float = STATS_WINDOW_SECONDS):
+        self.moments = WindowMoments(window / STATS_WINDOW_BUCKETS)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.ewma: Optional[float] = None
+        self.last_value: Optional[float] = None
+        self.last_at: Optional[float] = None
+        self.window_min = WindowExtreme(-1)
+        self.window_max = WindowExtreme(1)
+
+    @property
+    def variance(self) -> float:
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def observe(self, at: float, value: float, window: float, tau: float) -> bool:
+        # Возвращает False для запоздавшего значения (старше последнего в серии).
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.last_at is not None and at < self.last_at:
+            # EWMA уже ушло вперёд по времени, вставить в прошлое его нельзя.
+            if at >= self.last_at - window:
+                self.moments.push(at, value)
+                self.window_min.push(at, value)
+                self.window_max.push(at, value)
+            return False
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            self.ewma += (1 - math.exp(-(at - self.last_at) / tau)) * (value - self.ewma)
+        self.last_value, self.last_at = value, at
+        self.moments.push(at, value)
+        self.moments.expire(at - window)
+        for extreme in (self.window_min, self.window_max):
+            extreme.push(at, value)
+            extreme.expire(at - window)
+        return True
+
+    def snapshot(self, now: float, window: float) -> dict:
+        self.moments.expire(now - window)
+        for extreme in (self.window_min, self.window_max):
+            extreme.expire(now - window)
+        count, mean, m2 = self.moments.merged()
+        return {
+            "count": count,
+            "mean": mean if count else None,
+            "variance": m2 / (count - 1) if count > 1 else 0.0,
+            "total_count": self.count,
+            "total_mean": self.mean,
+            "total_variance": self.variance,
+            "ewma": self.ewma,
+            "min": self.window_min.value,
+            "max": self.window_max.value,
+            "last_value": self.last_value,
+            "last_at": str(datetime.datetime.fromtimestamp(self.last_at, datetime.timezone.utc)),
+        }
+
+
+class StreamingStats:
+    # Статистика по сериям показаний, обновляется на записи и живёт в памяти процесса;
+    # раз в STATS_CHECKPOINT_SECONDS изменившиеся серии сохраняются в series_stats,
+    # при старте загружаются обратно. Серию ведёт процесс, через который идут её показания
+    # (устройство держит одно соединение), поэтому при сохранении побеждает последняя запись.
+    def __init__(
+            self,
+            types: VitalTypeCache = vital_type_cache,
+            window: float = STATS_WINDOW_SECONDS,
+            tau: float = STATS_EWMA_TAU_SECONDS,
+    ):
+        self.types = types
+        self.window = window
+        self.tau = tau
+        self.series: Dict[_SeriesKey, SeriesStats] = {}
+        # Вторичный индекс, чтобы отдать всю палату, не перебирая все серии.
+        self.by_entity: Dict[Tuple[str, int], Dict[str, SeriesStats]] = {}
+        self.dirty: Set[_SeriesKey] = set()
+
+    def observe(self, kind: str, readings: Iterable):
+        late = 0
+        for reading in readings:
+            key = (kind, reading.entity_id, reading.type)
+            stats = self.series.get(key)
+            if stats is None:
+                stats = self._add(key, SeriesStats(self.window))
+            if not stats.observe(reading.saved_at.timestamp(), reading.value, self.window, self.tau):
+                late += 1
+            self.dirty.add(key)
+        if late:
+            metrics.inc("stats_late_values_total", late, kind=kind)
+
+    def for_entity(self, kind: str, entity_id: int, now: Optional[float] = None) -> Dict[str, dict]:
+        now = now if now is not None else datetime.datetime.now(datetime.timezone.utc).timestamp()
+        return {
+            type_: stats.snapshot(now, self.window)
+            for type_, stats in sorted(self.by_entity.get((kind, entity_id), {}).items())
+        }
+
+    async def load(self, database: Database):
+        rows = await database.fetch_all(series_stats.select())
+        for row in rows:
+            type_ = self.types.name_of(row.get("type_id"))
+            if not type_:
+                continue
+            stats = SeriesStats(self.window)
+            stats.moments = WindowMoments.restore(stats.moments.width, row.get("window_moments"))
+            stats.count, stats.mean, stats.m2 = row.get("count"), row.get("mean"), row.get("m2")
+            stats.ewma, stats.last_value = row.get("ewma"), row.get("last_value")
+            stats.last_at = row.get("last_at").timestamp() if row.get("last_at") is not None else None
+            stats.window_min = WindowExtreme.restore(-1, row.get("window_min"))
+            stats.window_max = WindowExtreme.restore(1, row.get("window_max"))
+            self._add((row.get("kind"), row.get("entity_id"), type_), stats)
+        logger.info("loaded %d series stats", len(rows))
+
+    async def checkpoint(self, database: Database):
+        dirty, self.dirty = self.dirty, set()
+        rows = [row for row in (self._row(key) for key in dirty) if row is not None]
+        try:
+            for start in range(0, len(rows), CHECKPOINT_BATCH_SIZE):
+                query = insert(series_stats).values(rows[start:start + CHECKPOINT_BATCH_SIZE])
+                query = query.on_conflict_do_update(
+                    index_elements=[series_stats.c.kind, series_stats.c.entity_id, series_stats.c.type_id],
+                    set_={
+                        column.name: query.excluded[column.name]
+                        for column in series_stats.columns if not column.primary_key
+                    },
+                )
+                # Фоновая работа: уступает и показаниям, и дашбордам.
+                async with admission.slot("export"):
+                    await database.execute(query)
+        except BaseException:
+            self.dirty |= dirty
+            raise
+        metrics.inc("stats_checkpointed_total", len(rows))
+
+    async def checkpoint_periodically(self, database: Database, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.checkpoint(database)
+            except Overloaded:
+                metrics.inc("stats_checkpoint_deferred_total")
+            except Exception as e:
+                logger.warning("stats checkpoint failed: %r", e)
+
+    def _add(self, key: _SeriesKey, stats: SeriesStats) -> SeriesStats:
+        kind, entity_id, type_ = key
+        self.series[key] = stats
+        self.by_entity.setdefault((kind, entity_id), {})[type_] = stats
+        return stats
+
+    def _row(self, key: _SeriesKey) -> Optional[dict]:
+        kind, entity_id, type_ = key
+        type_id = self.types.ids.get(type_)
+        stats = self.series[key]
+        if type_id is None or stats.last_at is None:
+            return None
+        return {
+            "kind": kind,
+            "entity_id": entity_id,
+            "type_id": type_id,
+            "count": stats.count,
+            "mean": stats.mean,
+            "m2": stats.m2,
+            "ewma": stats.ewma,
+            "last_value": stats.last_value,
+            "last_at": datetime.datetime.fromtimestamp(stats.last_at, datetime.timezone.utc),
+            "window_min": stats.window_min.dump(),
+            "window_max": stats.window_max.dump(),
+            "window_moments": stats.moments.dump(),
+        }
+
+
+streaming_stats = StreamingStats()
@@ -1,9 +1,10 @@
-from sqlalchemy import Table, Integer, Column, String, DateTime, ForeignKey, Float, Text
+from sqlalchemy import Table, Integer, SmallInteger, BigInteger, Column, String, DateTime, ForeignKey, Text, Index, REAL, Float, text
 
 from db import metadata
 
 _room_id = "rooms.id"
 _user_id = "users.id"
+_vital_type_id = "vital_types.id"
 _category_id = "categories.id"
 _retro_id = "retros.id"
 _tensions_id = "tensions.id"
@@ -33,6 +34,39 @@ users_rooms = Table(
     Column("room_id", ForeignKey(_room_id, ondelete="CASCADE"), nullable=False),
 )
 
+# Каталог шардов: на каком шарде живёт палата (см. shards.py). Только на шарде 0.
+room_shards = Table(
+    "room_shards",
+    metadata,
+    Column("room_id", Integer, primary_key=True, autoincrement=False),
+    Column("shard", SmallInteger, nullable=False),
+)
+
+# Каталог: палата пациента, по ней выбирается шард его данных. Только на шарде 0.
+patient_rooms = Table(
+    "patient_rooms",
+    metadata,
+    Column("user_id", Integer, primary_key=True, autoincrement=False),
+    Column("room_id", Integer, nullable=False),
+)
+
+# Палаты и пациенты, уехавшие (или уезжающие) с этого шарда: запись их данных
+# сюда запрещена (см. ShardMap.guard). На каждом шарде свои.
+shard_fences = Table(
+    "shard_fences",
+    metadata,
+    Column("kind", String, primary_key=True),
+    Column("entity_id", Integer, primary_key=True, autoincrement=False),
+)
+
+# Справочник типов показателей: в таблицах показаний хранится только smallint.
+vital_types = Table(
+    "vital_types",
+    metadata,
+    Column("id", SmallInteger, primary_key=True, autoincrement=True),
+    Column("name", String, unique=True, nullable=False),
+)
+
 stats_pacient_temp = Table(
     "temp",
     metadata,
@@ -45,30 +79,79 @@ stats_patient = Table(
     "stats_patient",
     metadata,
     Column("user_id",  ForeignKey(_user_id, ondelete="CASCADE"), nullable=False),
-    Column("type", String, nullable=False),
-    Column("value", Float),
-    Column("saved_at", DateTime(timezone=True))
+    Column("saved_at", DateTime(timezone=True)),
+    Column("type_id", ForeignKey(_vital_type_id), nullable=False),
+    Column("value", REAL),
+    # Устройство и его сквозной номер показания: повторно присланное показание не задваивается.
+    Column("device_id", String),
+    Column("seq", BigInteger),
+    # Порядковый номер вставки: по нему rebalance.py докопирует новое при переносе.
+    Column("row_id", BigInteger, server_default=text("nextval('stats_patient_row_id_seq')"), nullable=False),
 )
 
+# Индексы под выборки "последние N значений": строятся онлайн, см. online_migrations.py.
+Index("ix_stats_patient_user_type_id_saved_at", stats_patient.c.user_id, stats_patient.c.type_id, stats_patient.c.saved_at.desc())
+Index("ux_stats_patient_device_seq", stats_patient.c.device_id, stats_patient.c.seq,
+      unique=True, postgresql_where=stats_patient.c.device_id.isnot(None))
+Index("ix_stats_patient_user_id_row_id", stats_patient.c.user_id, stats_patient.c.row_id)
+
 
 stats_room = Table(
     "stats_room",
     metadata,
     Column("room_id",  ForeignKey(_room_id, ondelete="CASCADE"), nullable=False),
-    Column("type", String, nullable=False),
-    Column("value", Float),
-    Column("saved_at", DateTime(timezone=True))
+    Column("saved_at", DateTime(timezone=True)),
+    Column("type_id", ForeignKey(_vital_type_id), nullable=False),
+    Column("value", REAL),
+    Column("device_id", String),
+    Column("seq", BigInteger),
+    Column("row_id", BigInteger, server_default=text("nextval('stats_room_row_id_seq')"), nullable=False),
 )
 
+Index("ix_stats_room_room_type_id_saved_at", stats_room.c.room_id, stats_room.c.type_id, stats_room.c.saved_at.desc())
+Index("ux_stats_room_device_seq", stats_room.c.device_id, stats_room.c.seq,
+      unique=True, postgresql_where=stats_room.c.device_id.isnot(None))
+Index("ix_stats_room_room_id_row_id", stats_room.c.room_id, stats_room.c.row_id)
+
 room_params = Table(
     "room_params",
     metadata,
     Column("room_id",  ForeignKey(_room_id, ondelete="CASCADE"), nullable=False),
-    Column("type", String, nullable=False),
-    Column("value", Float),
-    Column("saved_at", DateTime(timezone=True))
+    Column("saved_at", DateTime(timezone=True)),
+    Column("type_id", ForeignKey(_vital_type_id), nullable=False),
+    Column("value", REAL),
+    Column("device_id", String),
+    Column("seq", BigInteger),
+    Column("row_id", BigInteger, server_default=text("nextval('room_params_row_id_seq')"), nullable=False),
+)
+
+Index("ix_room_params_room_type_id_saved_at", room_params.c.room_id, room_params.c.type_id, room_params.c.saved_at.desc())
+Index("ux_room_params_device_seq", room_params.c.device_id, room_params.c.seq,
+      unique=True, postgresql_where=room_params.c.device_id.isnot(None))
+Index("ix_room_params_room_id_row_id", room_params.c.room_id, room_params.c.row_id)
+
+# Сохранённое состояние потоковой статистики по сериям (см. streaming_stats.py). Только на шарде 0.
+series_stats = Table(
+    "series_stats",
+    metadata,
+    Column("kind", String, primary_key=True),
+    Column("entity_id", Integer, primary_key=True, autoincrement=False),
+    Column("type_id", ForeignKey(_vital_type_id), primary_key=True),
+    Column("count", BigInteger, nullable=False),
+    Column("mean", Float, nullable=False),
+    Column("m2", Float, nullable=False),
+    Column("ewma", Float),
+    Column("last_value", Float),
+    Column("last_at", DateTime(timezone=True)),
+    # Монотонные очереди окна min/max, JSON [[время, значение], ...].
+    Column("window_min", Text),
+    Column("window_max", Text),
+    # Корзины окна для count/mean/variance, JSON [[начало, count, mean, m2], ...].
+    Column("window_moments", Text),
 )
 
+# id анализов и назначений выдаёт последовательность каталога (rozbory_id_seq, jmenovani_id_seq
+# на шарде 0), чтобы при переносе пациента они не совпали с чужими на другом шарде.
 rozbory = Table(
     "rozbory",
     metadata,
@@ -76,9 +159,12 @@ rozbory = Table(
     Column("user_id", ForeignKey(_user_id, ondelete="CASCADE"), nullable=False),
     Column("author_id", ForeignKey(_user_id, ondelete="CASCADE"), nullable=False),
     Column("text", Text),
-    Column("saved_at", DateTime(timezone=True), nullable=False)
+    Column("saved_at", DateTime(timezone=True), nullable=False),
+    Column("row_id", BigInteger, server_default=text("nextval('rozbory_row_id_seq')"), nullable=False),
 )
 
+Index("ix_rozbory_user_id_row_id", rozbory.c.user_id, rozbory.c.row_id)
+
 jmenovani = Table(
     "jmenovani",
     metadata,
@@ -86,5 +172,8 @@ jmenovani = Table(
     Column("user_id", ForeignKey(_user_id, ondelete="CASCADE"), nullable=False),
     Column("author_id", ForeignKey(_user_id, ondelete="CASCADE"), nullable=False),
     Column("text", Text),
-    Column("saved_at", DateTime(timezone=True), nullable=False)
-)
\ No newline at end of file
+    Column("saved_at", DateTime(timezone=True), nullable=False),
+    Column("row_id", BigInteger, server_default=text("nextval('jmenovani_row_id_seq')"), nullable=False),
+)
+
+Index("ix_jmenovani_user_id_row_id", jmenovani.c.user_id, jmenovani.c.row_id)
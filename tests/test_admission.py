@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionClass, AdmissionController, Overloaded
+
+
+def make_controller(capacity: int = 1) -> AdmissionController:
+    return AdmissionController(
+        capacity=capacity,
+        classes={
+            "ingestion": AdmissionClass(priority=0, limit=capacity, budget=1.0, max_queue=10),
+            "dashboard": AdmissionClass(priority=2, limit=1, budget=0.05, max_queue=1),
+        },
+    )
+
+
+def test_freed_slot_goes_to_higher_priority_waiter():
+    async def scenario():
+        admission = make_controller()
+        await admission.acquire("ingestion")
+        order = []
+
+        async def wait(request_class):
+            async with admission.slot(request_class):
+                order.append(request_class)
+
+        dashboard = asyncio.ensure_future(wait("dashboard"))
+        await asyncio.sleep(0)
+        ingestion = asyncio.ensure_future(wait("ingestion"))
+        await asyncio.sleep(0)
+        admission.release("ingestion")
+        await asyncio.gather(dashboard, ingestion, return_exceptions=True)
+        return order, admission.in_use
+
+    order, in_use = asyncio.run(scenario())
+    # Дашборд встал в очередь раньше, но приём показаний важнее.
+    assert order[0] == "ingestion"
+    assert in_use == 0
+
+
+def test_class_limit_leaves_room_for_other_classes():
+    async def scenario():
+        admission = make_controller(capacity=3)
+        await admission.acquire("dashboard")
+        with pytest.raises(Overloaded):
+            await admission.acquire("dashboard")
+        await admission.acquire("ingestion")
+        return admission.active
+
+    assert asyncio.run(scenario()) == {"ingestion": 1, "dashboard": 1}
+
+
+def test_waiting_past_budget_sheds_with_retry_after():
+    async def scenario():
+        admission = make_controller()
+        await admission.acquire("ingestion")
+        with pytest.raises(Overloaded) as raised:
+            await admission.acquire("dashboard")
+        return admission, raised.value
+
+    admission, error = asyncio.run(scenario())
+    assert error.request_class == "dashboard" and error.retry_after >= 1
+    assert admission.waiting["dashboard"] == 0
+    assert admission.in_use == 1
+
+
+def test_full_queue_sheds_immediately():
+    async def scenario():
+        admission = make_controller()
+        await admission.acquire("ingestion")
+        waiter = asyncio.ensure_future(admission.acquire("dashboard"))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await admission.acquire("dashboard")
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return admission
+
+    admission = asyncio.run(scenario())
+    assert admission.waiting["dashboard"] == 0
+
+
+def test_cancelled_waiter_does_not_keep_a_slot():
+    async def scenario():
+        admission = make_controller()
+        await admission.acquire("ingestion")
+        waiter = asyncio.ensure_future(admission.acquire("ingestion"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        admission.release("ingestion")
+        return admission
+
+    admission = asyncio.run(scenario())
+    assert admission.in_use == 0
+    assert admission.waiting["ingestion"] == 0
+
+
+def test_overloaded_maps_to_503_with_retry_after():
+    from app import app
+
+    response = asyncio.run(app.exception_handlers[Overloaded](None, Overloaded("dashboard", retry_after=3)))
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "3"
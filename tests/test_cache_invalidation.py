@@ -0,0 +1,89 @@
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+
+import pytest
+from databases import Database
+from sqlalchemy import select
+
+from conftest import SHARD_URLS, migrate
+from models import RoomsRepository, StatsPatientRepo, UsersRepository, utcnow
+from tables import rooms, users
+from vital_types import VitalTypeCache
+
+pytestmark = pytest.mark.skipif(not SHARD_URLS, reason="needs TEST_SHARD_DATABASE_URLS")
+
+
+def setup_module():
+    migrate(SHARD_URLS[:1])
+
+
+class TrackedDatabase(Database):
+    # Считает открытые транзакции: кэш должен сбрасываться только после коммита.
+    depth = 0
+
+    @asynccontextmanager
+    async def transaction(self, **kwargs):
+        async with super().transaction(**kwargs):
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+
+
+def _with_patient(scenario):
+    async def run():
+        database = TrackedDatabase(SHARD_URLS[0])
+        await database.connect()
+        try:
+            name, login = uuid.uuid4().hex, uuid.uuid4().hex
+            await RoomsRepository(database).create(name)
+            room_id = await database.fetch_val(select((rooms.c.id,)).where(rooms.c.name == name))
+            await UsersRepository(database).create(room_id, "Иван", "Иванов", "", login)
+            patient_id = await database.fetch_val(select((users.c.id,)).where(users.c.login == login))
+            return await scenario(database, StatsPatientRepo(database, types=VitalTypeCache()), room_id, patient_id)
+        finally:
+            await database.disconnect()
+    return asyncio.run(run())
+
+
+def _record_invalidations(monkeypatch, method, database, calls):
+    original = method.invalidate
+
+    def invalidate(**match):
+        calls.append((match, database.depth))
+        original(**match)
+
+    monkeypatch.setattr(method, "invalidate", invalidate)
+
+
+def test_room_series_cache_is_dropped_after_commit(monkeypatch):
+    calls = []
+
+    async def scenario(database, repo, room_id, patient_id):
+        _record_invalidations(monkeypatch, StatsPatientRepo.get_stats_room, database, calls)
+        await repo.push_new_value_room(room_id, "temp", 20.0)
+        first = await repo.get_stats_room("temp", room_id)
+        await repo.push_spooled([
+            {"k": "room", "e": room_id, "t": "temp", "v": 21.0, "s": utcnow().isoformat()},
+        ])
+        return room_id, first, await repo.get_stats_room("temp", room_id)
+
+    room_id, first, second = _with_patient(scenario)
+    assert calls == [({"room_id": room_id}, 0), ({"room_id": room_id}, 0)]
+    assert len(first) == 1 and len(second) == 2
+
+
+def test_analyses_and_prescriptions_drop_the_patients_cache(monkeypatch):
+    calls = []
+
+    async def scenario(database, repo, room_id, patient_id):
+        _record_invalidations(monkeypatch, StatsPatientRepo.get_anals, database, calls)
+        _record_invalidations(monkeypatch, StatsPatientRepo.get_jmenovani, database, calls)
+        await repo.push_anal(patient_id, patient_id, "анализ")
+        await repo.push_jmenovani(patient_id, patient_id, "назначение")
+        return patient_id
+
+    patient_id = _with_patient(scenario)
+    assert calls == [({"user_id": patient_id}, 0), ({"user_id": patient_id}, 0)]
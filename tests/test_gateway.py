@@ -0,0 +1,60 @@
+import asyncio
+import datetime
+import json
+
+from gateway import DeviceSession
+from models import Reading
+from spool import SpoolFull
+
+NOW = datetime.datetime(2026, 10, 19, tzinfo=datetime.timezone.utc)
+
+
+class FakeWebSocket:
+    def __init__(self, incoming=()):
+        self.incoming = list(incoming)
+        self.sent = []
+
+    async def send_text(self, text: str):
+        self.sent.append(json.loads(text))
+
+    async def receive_text(self) -> str:
+        if not self.incoming:
+            await asyncio.Event().wait()
+        return self.incoming.pop(0)
+
+
+class FailingRepository:
+    def __init__(self, error: Exception):
+        self.error = error
+
+    async def push_batch(self, patients, rooms, create_types=True):
+        raise self.error
+
+
+def test_full_spool_asks_device_to_resend():
+    websocket = FakeWebSocket()
+    session = DeviceSession(websocket, "monitor-1", FailingRepository(SpoolFull("vitals.spool")))
+    session.in_flight = 1
+    asyncio.run(session._write_separately([(7, [Reading(1, "pulse", 60.0, NOW)], [])]))
+    assert [(message["type"], message["ids"]) for message in websocket.sent] == [("nack", [7])]
+
+
+def test_invalid_batch_is_rejected_by_id_when_id_is_readable():
+    websocket = FakeWebSocket([
+        json.dumps({"type": "batch", "id": 3, "readings": [{"patient_id": 1, "type": "pulse"}]}),
+        json.dumps({"type": "batch", "readings": []}),
+        "not json",
+    ])
+    session = DeviceSession(websocket, "monitor-1", FailingRepository(AssertionError()))
+
+    async def scenario():
+        receiver = asyncio.ensure_future(session.receive_loop())
+        await asyncio.sleep(0.05)
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert [(message["type"], message["ids"]) for message in websocket.sent] == [
+        ("reject", [3]), ("nack", []), ("nack", []),
+    ]
+    assert session.in_flight == 0
@@ -0,0 +1,89 @@
+import asyncio
+
+from broadcaster import Broadcast
+
+from hub import ChannelHub, ReplayLog
+
+
+def test_replay_log_returns_events_after_last_seq():
+    log = ReplayLog(max_events=10, max_age=60)
+    for message in ("a", "b", "c"):
+        log.append(message)
+    assert log.since(1) == [(2, "b"), (3, "c")]
+    assert log.since(3) == []
+
+
+def test_replay_log_cannot_replay_what_it_no_longer_holds():
+    log = ReplayLog(max_events=2, max_age=60)
+    for message in ("a", "b", "c"):
+        log.append(message)
+    assert log.since(0) is None
+    assert log.since(1) == [(2, "b"), (3, "c")]
+    # Номер из будущего — клиент видел другую нумерацию.
+    assert log.since(5) is None
+
+
+def test_replay_log_expires_by_age():
+    log = ReplayLog(max_events=10, max_age=-1)
+    log.append("a")
+    assert log.is_expired()
+    assert log.since(0) is None
+
+
+async def _collect(queue: asyncio.Queue, count: int) -> list:
+    items = [await asyncio.wait_for(queue.get(), timeout=1) for _ in range(count)]
+    await asyncio.sleep(0.05)
+    assert queue.empty()
+    return items
+
+
+def _with_hub(scenario):
+    async def run():
+        broadcast = Broadcast("memory://")
+        await broadcast.connect()
+        hub = ChannelHub(broadcast)
+        try:
+            return await scenario(hub)
+        finally:
+            await hub.close()
+            await broadcast.disconnect()
+    return asyncio.run(run())
+
+
+def test_subscriber_gets_missed_and_new_events_exactly_once():
+    async def scenario(hub):
+        await hub.publish("ward", "a")
+        queue = hub.queue()
+        hub.subscribe("ward", queue, last_seq=0, epoch=hub.epoch)
+        # Опубликовано до того, как насос подписался на брокер.
+        await hub.publish("ward", "b")
+        await asyncio.sleep(0.05)
+        await hub.publish("ward", "c")
+        return await _collect(queue, 3)
+
+    items = _with_hub(scenario)
+    assert [(item["seq"], item["message"]) for item in items] == [(1, "a"), (2, "b"), (3, "c")]
+
+
+def test_foreign_epoch_gets_resync_instead_of_replay():
+    async def scenario(hub):
+        await hub.publish("ward", "a")
+        queue = hub.queue()
+        hub.subscribe("ward", queue, last_seq=0, epoch="another-worker")
+        return hub.epoch, await _collect(queue, 1)
+
+    epoch, items = _with_hub(scenario)
+    assert items == [{"type": "resync", "channel": "ward", "epoch": epoch, "seq": 1}]
+
+
+def test_slow_subscriber_loses_oldest_events_only():
+    async def scenario(hub):
+        hub.queue_size = 2
+        queue = hub.queue()
+        for message in ("a", "b", "c"):
+            hub.offer(queue, {"message": message})
+        return hub.dropped, await _collect(queue, 2)
+
+    dropped, items = _with_hub(scenario)
+    assert dropped == 1
+    assert [item["message"] for item in items] == ["b", "c"]
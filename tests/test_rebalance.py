@@ -0,0 +1,178 @@
+import asyncio
+import time
+import uuid
+
+import asyncpg
+import pytest
+from databases import Database
+from sqlalchemy import func, select
+
+import rebalance
+from conftest import SHARD_URLS as URLS, migrate
+from models import Reading, RoomsRepository, StatsPatientRepo, UsersRepository, utcnow
+from shards import Fenced, ShardMap
+from tables import rooms, rozbory, stats_patient, users, users_rooms
+from vital_types import VitalTypeCache
+
+pytestmark = pytest.mark.skipif(len(URLS) < 2, reason="needs TEST_SHARD_DATABASE_URLS with two databases")
+
+
+def setup_module():
+    migrate(URLS)
+
+
+async def _connected(urls) -> ShardMap:
+    shards = ShardMap([Database(url) for url in urls])
+    await shards.catalog.connect()
+    await shards.connect()
+    await shards.load()
+    return shards
+
+
+async def _count(database: Database, patient_id: int, table=stats_patient) -> int:
+    query = select((func.count(),)).select_from(table).where(table.c.user_id == patient_id)
+    return await database.fetch_val(query)
+
+
+async def _create_patient(shards: ShardMap, target_index: int = None):
+    # Палата с пациентом; с target_index — палата переносится на этот шард.
+    name, login = uuid.uuid4().hex, uuid.uuid4().hex
+    await RoomsRepository(shards.catalog, shards=shards).create(name)
+    room_ids = await shards.fan_out(lambda d: d.fetch_val(select((rooms.c.id,)).where(rooms.c.name == name)))
+    room_id = next(room_id for room_id in room_ids if room_id is not None)
+    if target_index is not None:
+        await rebalance.move_room(shards, room_id, target_index, grace=0)
+    await UsersRepository(shards.catalog, shards=shards).create(room_id, "Иван", "Иванов", "", login)
+    patient_id = await shards.catalog.fetch_val(select((users.c.id,)).where(users.c.login == login))
+    return room_id, patient_id
+
+
+async def _move_under_load():
+    shards = await _connected(URLS)
+    # Второй процесс со своей картой: о переносе он узнаёт только по забору.
+    stale = await _connected(URLS)
+    try:
+        await rebalance.sync_reference(shards)
+        await rebalance.sync_ids(shards)
+        room_id, patient_id = await _create_patient(shards)
+        source_index = shards.index_of_room(room_id)
+        target_index = 1 - source_index
+        assert shards.for_patient(patient_id) is shards.databases[source_index]
+        # На целевом шарде уже есть свои анализы: id перенесённых не должны с ними совпасть.
+        _, neighbour_id = await _create_patient(shards, target_index)
+        await stale.load()
+
+        types = VitalTypeCache()
+        types.replicas = shards.replicas
+        repo = StatsPatientRepo(shards.catalog, types=types, shards=stale)
+        await repo.push_new_value(patient_id, "pulse", 60)
+        await repo.push_anal(patient_id, neighbour_id, "neighbour")
+        await repo.push_anal(patient_id, patient_id, "before the move")
+
+        users_repo = UsersRepository(shards.catalog, shards=stale)
+        written, anals, admitted = 1, 1, []
+        moving = asyncio.ensure_future(rebalance.move_room(shards, room_id, target_index, grace=0))
+        while not moving.done() or written < 200:
+            try:
+                # Анализ на каждые 20 показаний, новый пациент в палате — на каждые 50.
+                if anals * 20 <= written:
+                    await repo.push_anal(patient_id, patient_id, "during the move")
+                    anals += 1
+                    continue
+                if (len(admitted) + 1) * 50 <= written:
+                    login = uuid.uuid4().hex
+                    await users_repo.create(room_id, "Пётр", "Петров", "", login)
+                    admitted.append(login)
+                    continue
+                await repo.push_new_values([Reading(patient_id, "pulse", 60 + written % 40, utcnow())])
+            except Fenced:
+                # Остаток докопируется под забором: устройство получает nack и повторяет.
+                await asyncio.sleep(0.01)
+                continue
+            written += 1
+            await asyncio.sleep(0)
+        await moving
+
+        assert stale.databases.index(stale.for_patient(patient_id)) == target_index
+        assert await _count(shards.databases[target_index], patient_id) == written
+        assert await _count(shards.databases[source_index], patient_id) == 0
+        await repo.push_anal(patient_id, patient_id, "after the move")
+        assert await _count(shards.databases[target_index], patient_id, rozbory) == anals + 1
+        assert await _count(shards.databases[source_index], patient_id, rozbory) == 0
+        values = await StatsPatientRepo(shards.catalog, types=types, shards=shards).get_n_last_values(
+            patient_id, "pulse", count=written,
+        )
+        assert len(values) == written
+        for login in admitted:
+            user_id = await shards.catalog.fetch_val(select((users.c.id,)).where(users.c.login == login))
+            query = select((users_rooms.c.room_id,)).where(users_rooms.c.user_id == user_id)
+            assert await shards.databases[target_index].fetch_val(query) == room_id
+            assert await shards.databases[source_index].fetch_val(query) is None
+    finally:
+        for shard_map in (shards, stale):
+            await shard_map.disconnect()
+            await shard_map.catalog.disconnect()
+
+
+def test_move_room_keeps_every_reading_written_during_the_move():
+    asyncio.run(_move_under_load())
+
+
+async def _watermarks_next_to(statement: str):
+    # Чужая открытая транзакция рядом с переносом.
+    other = await asyncpg.connect(URLS[0])
+    database = Database(URLS[0])
+    await database.connect()
+    try:
+        await other.execute("BEGIN")
+        await other.execute(statement)
+        # Завершённая транзакция позже неё, чтобы открытая попала в снимок как выполняющаяся.
+        await database.execute("SELECT txid_current()")
+        return await rebalance.watermarks(database, {stats_patient})
+    finally:
+        await other.close()
+        await database.disconnect()
+
+
+def test_watermarks_ignore_transactions_outside_moved_tables():
+    marks = asyncio.run(asyncio.wait_for(
+        _watermarks_next_to("CREATE TEMP TABLE unrelated AS SELECT 1 AS x"), timeout=5,
+    ))
+    assert set(marks) == {stats_patient}
+
+
+def test_watermarks_give_up_on_a_stalled_writer(monkeypatch):
+    monkeypatch.setattr(rebalance, "WRITERS_TIMEOUT", 0.3)
+    with pytest.raises(rebalance.StalledWriters):
+        asyncio.run(_watermarks_next_to("LOCK TABLE stats_patient IN ROW EXCLUSIVE MODE"))
+
+
+async def _transfer_across_shards():
+    shards = await _connected(URLS)
+    try:
+        await rebalance.sync_reference(shards)
+        source_room, patient_id = await _create_patient(shards)
+        source_index = shards.index_of_room(source_room)
+        target_room, _ = await _create_patient(shards, 1 - source_index)
+        types = VitalTypeCache()
+        types.replicas = shards.replicas
+        await StatsPatientRepo(shards.catalog, types=types, shards=shards).push_new_value(patient_id, "pulse", 60)
+
+        started = time.monotonic()
+        await UsersRepository(shards.catalog, shards=shards).transfer(patient_id, target_room)
+        switched_in = time.monotonic() - started
+        assert shards.for_patient(patient_id) is shards.databases[1 - source_index]
+        assert await _count(shards.databases[1 - source_index], patient_id) == 1
+        assert await _count(shards.databases[source_index], patient_id) == 1
+
+        await asyncio.sleep(rebalance.GRACE_SECONDS + 0.5)
+        assert await _count(shards.databases[source_index], patient_id) == 0
+        return switched_in
+    finally:
+        await shards.disconnect()
+        await shards.catalog.disconnect()
+
+
+def test_transfer_does_not_wait_for_old_shard_cleanup(monkeypatch):
+    monkeypatch.setattr(rebalance, "GRACE_SECONDS", 1.0)
+    assert asyncio.run(_transfer_across_shards()) < rebalance.GRACE_SECONDS
@@ -0,0 +1,117 @@
+import asyncio
+import datetime
+
+from models import Reading, StatsPatientRepo
+from shards import Fenced, ShardMap
+
+NOW = datetime.datetime(2026, 10, 19, tzinfo=datetime.timezone.utc)
+
+
+class FakeDatabase:
+    # Столько от Database, сколько читает ShardMap: выборки из таблиц каталога,
+    # в том числе с фильтром column IN (...).
+    def __init__(self, name: str, **tables):
+        self.name = name
+        self.tables = tables
+        self.fetched = []
+
+    async def fetch_all(self, query, values=None):
+        table = query.selected_columns[0].table.name
+        rows = self.tables.get(table, [])
+        where = query.whereclause
+        if where is not None:
+            rows = [row for row in rows if row[where.left.name] in where.right.value]
+        self.fetched.append(table)
+        return rows
+
+    def __repr__(self):
+        return "FakeDatabase({})".format(self.name)
+
+
+def make_shards() -> ShardMap:
+    catalog = FakeDatabase(
+        "catalog",
+        room_shards=[{"room_id": 1, "shard": 1}, {"room_id": 2, "shard": 2}],
+        patient_rooms=[{"user_id": 10, "room_id": 1}, {"user_id": 20, "room_id": 2}, {"user_id": 30, "room_id": 3}],
+    )
+    shards = ShardMap([catalog, FakeDatabase("shard1"), FakeDatabase("shard2")])
+    asyncio.run(shards.load())
+    return shards
+
+
+def test_rooms_route_to_assigned_shard():
+    shards = make_shards()
+    assert shards.for_room(1) is shards.databases[1]
+    assert shards.for_room(2) is shards.databases[2]
+    # Палаты без назначения — данные до шардирования, на каталоге.
+    assert shards.for_room(3) is shards.catalog
+
+
+def test_patients_follow_their_room_from_catalog():
+    shards = make_shards()
+    assert shards.for_patient(10) is shards.databases[1]
+    assert shards.for_patient(20) is shards.databases[2]
+    assert shards.for_patient(30) is shards.catalog
+    assert shards.for_patient(99) is shards.catalog
+
+
+def test_locate_finds_patients_placed_by_another_process():
+    shards = make_shards()
+    catalog = shards.catalog
+    catalog.tables["room_shards"].append({"room_id": 4, "shard": 1})
+    catalog.tables["patient_rooms"].append({"user_id": 40, "room_id": 4})
+    assert shards.for_patient(40) is catalog
+
+    asyncio.run(shards.locate(patients=[40]))
+    assert shards.for_patient(40) is shards.databases[1]
+
+
+def test_locate_remembers_misses():
+    shards = make_shards()
+    catalog = shards.catalog
+    asyncio.run(shards.locate(patients=[50]))
+    fetched = len(catalog.fetched)
+    asyncio.run(shards.locate(patients=[50]))
+    assert len(catalog.fetched) == fetched
+    assert shards.for_patient(50) is catalog
+
+
+def test_least_loaded_picks_emptiest_shard():
+    shards = make_shards()
+    # Каталог держит только неназначенные палаты, которых карта не знает.
+    assert shards.least_loaded() == 0
+    shards.assignments.update({5: 0, 6: 0})
+    assert shards.least_loaded() == 1
+
+
+def test_group_splits_batch_by_shard():
+    shards = make_shards()
+    repo = StatsPatientRepo(shards.catalog, shards=shards)
+    patients = [Reading(10, "pulse", 60, NOW), Reading(20, "pulse", 70, NOW), Reading(30, "pulse", 80, NOW)]
+    rooms = [Reading(1, "temp", 21, NOW), Reading(2, "temp", 22, NOW)]
+
+    groups = repo._group(patients, rooms)
+
+    assert groups[shards.databases[1]] == ([patients[0]], [rooms[0]])
+    assert groups[shards.databases[2]] == ([patients[1]], [rooms[1]])
+    assert groups[shards.catalog] == ([patients[2]], [])
+
+
+def test_fenced_write_is_rerouted_after_reload():
+    shards = make_shards()
+    repo = StatsPatientRepo(shards.catalog, shards=shards)
+    written = []
+
+    async def write(database, group):
+        if database is shards.databases[1]:
+            raise Fenced("room 1")
+        written.append((database, group))
+
+    repo._write = write
+    # Палату 1 перенесли на шард 2; этот процесс узнаёт об этом только по забору.
+    shards.catalog.tables["room_shards"][0]["shard"] = 2
+    reading = Reading(10, "pulse", 60, NOW)
+
+    asyncio.run(repo.push_batch([reading], []))
+
+    assert written == [(shards.databases[2], ([reading], []))]
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+from spool import Spool, SpoolDrainer, SpoolFull
+
+
+def reading(number: int) -> dict:
+    return {"k": "patient", "e": 1, "t": "pulse", "v": float(number), "s": "2026-10-19T00:00:00+00:00", "a": 0}
+
+
+def open_spool(tmp_path, **options) -> Spool:
+    options.setdefault("initial_size", 4096)
+    spool = Spool(str(tmp_path / "vitals.spool"), **options)
+    spool.open()
+    return spool
+
+
+def values(records) -> list:
+    return [record["v"] for record in records]
+
+
+def test_reads_in_append_order_and_survives_reopen(tmp_path):
+    spool = open_spool(tmp_path)
+    spool.append([reading(1), reading(2)])
+    spool.append([reading(3)])
+    assert spool.pending == 3
+    records, offset = spool.read(2)
+    assert values(records) == [1, 2]
+    spool.commit(offset, len(records))
+    spool.close()
+
+    spool = open_spool(tmp_path)
+    assert spool.pending == 1
+    assert values(spool.read(10)[0]) == [3]
+
+
+def test_torn_tail_is_dropped_on_recovery(tmp_path):
+    spool = open_spool(tmp_path)
+    spool.append([reading(1)])
+    end = spool.write_offset
+    spool.append([reading(2), reading(3)])
+    # Падение посреди записи тела: контрольная сумма не сходится.
+    spool._map[end + 20:end + 24] = b"xxxx"
+    spool.close()
+
+    spool = open_spool(tmp_path)
+    assert spool.pending == 1
+    assert values(spool.read(10)[0]) == [1]
+    assert spool.write_offset == end
+
+
+def test_drained_records_of_old_epoch_are_not_replayed(tmp_path):
+    spool = open_spool(tmp_path)
+    spool.append([reading(1), reading(2)])
+    records, offset = spool.read(10)
+    spool.commit(offset, len(records))
+    assert spool.is_empty and spool.write_offset == 0
+    spool.close()
+
+    # Байты записей остались в файле, но они из прошлой эпохи.
+    spool = open_spool(tmp_path)
+    assert spool.is_empty
+    assert spool.read(10) == ([], 0)
+
+
+def test_failed_append_leaves_nothing_behind(tmp_path):
+    spool = open_spool(tmp_path, max_size=8192)
+    spool.append([reading(1)])
+    with pytest.raises(SpoolFull):
+        spool.append([reading(number) for number in range(1000)])
+    assert spool.pending == 1
+    spool.close()
+
+    spool = open_spool(tmp_path, max_size=8192)
+    assert values(spool.read(10)[0]) == [1]
+
+
+def test_steady_ingest_compacts_instead_of_filling_up(tmp_path):
+    # Выгрузка ни разу не догоняет запись: пока пишется пачка, приходят новые.
+    spool = open_spool(tmp_path, max_size=2 ** 16)
+    spool.append([reading(number) for number in range(5)])
+    appended, drained = 5, 0
+    for _ in range(2000):
+        for _ in range(10):
+            spool.append([reading(appended)])
+            appended += 1
+        records, offset = spool.read(10)
+        assert values(records) == list(range(drained, drained + len(records)))
+        drained += len(records)
+        spool.commit(offset, len(records))
+        assert not spool.is_empty
+    assert spool.pending == appended - drained
+    assert values(spool.read(appended)[0]) == list(range(drained, appended))
+
+
+def test_compacted_tail_survives_reopen(tmp_path):
+    spool = open_spool(tmp_path, compact_size=0)
+    spool.append([reading(1), reading(2)])
+    spool.append([reading(3)])
+    records, offset = spool.read(2)
+    spool.commit(offset, len(records))
+    assert spool.read_offset == 0
+    spool.close()
+
+    spool = open_spool(tmp_path, compact_size=0)
+    assert spool.pending == 1
+    assert values(spool.read(10)[0]) == [3]
+
+
+def test_drainer_retries_failed_batch_in_order(tmp_path):
+    spool = open_spool(tmp_path)
+    spool.append([reading(1), reading(2)])
+    spool.append([reading(3)])
+    written, failures = [], [ConnectionError("db is down")]
+
+    async def write(records):
+        if failures:
+            raise failures.pop()
+        written.extend(values(records))
+
+    async def drain():
+        drainer = SpoolDrainer(spool, write, batch_size=2, idle_interval=0.001)
+        task = asyncio.ensure_future(drainer.run())
+        while not spool.is_empty:
+            await asyncio.sleep(0.001)
+        task.cancel()
+
+    asyncio.run(asyncio.wait_for(drain(), timeout=5))
+    assert written == [1, 2, 3]
@@ -0,0 +1,59 @@
+import random
+import statistics
+
+import pytest
+
+from streaming_stats import SeriesStats, WindowExtreme, WindowMoments
+
+
+def test_window_moments_match_brute_force_in_any_order():
+    rng = random.Random(7)
+    points = [(rng.uniform(0, 100), rng.gauss(70, 10)) for _ in range(500)]
+    moments = WindowMoments(width=10)
+    for at, value in points:
+        moments.push(at, value)
+    moments.expire(before=45)
+    # Корзина [40, 50) ещё не вышла из окна целиком и учитывается вся.
+    kept = [value for at, value in points if at >= 40]
+    count, mean, m2 = moments.merged()
+    assert count == len(kept)
+    assert mean == pytest.approx(statistics.mean(kept))
+    assert m2 / (count - 1) == pytest.approx(statistics.variance(kept))
+
+
+def test_window_moments_survive_dump_and_restore():
+    moments = WindowMoments(width=5)
+    for at, value in ((1, 10.0), (7, 20.0), (3, 30.0)):
+        moments.push(at, value)
+    restored = WindowMoments.restore(5, moments.dump())
+    assert restored.merged() == moments.merged()
+    restored.push(12, 40.0)
+    assert restored.merged()[0] == 4
+
+
+def test_window_extreme_tracks_max_and_min_with_late_values():
+    window_max, window_min = WindowExtreme(1), WindowExtreme(-1)
+    for at, value in ((1, 5.0), (2, 3.0), (4, 4.0), (3, 9.0), (5, 1.0)):
+        window_max.push(at, value)
+        window_min.push(at, value)
+    assert window_max.value == 9.0
+    assert window_min.value == 1.0
+    window_max.expire(before=4)
+    assert window_max.value == 4.0
+    window_max.expire(before=6)
+    assert window_max.value is None
+    assert WindowExtreme.restore(-1, window_min.dump()).value == 1.0
+
+
+def test_snapshot_is_windowed_and_keeps_lifetime_totals():
+    stats = SeriesStats(window=60)
+    for at, value in ((0, 100.0), (10, 100.0), (200, 60.0), (210, 80.0)):
+        stats.observe(at, value, window=60, tau=30)
+    snapshot = stats.snapshot(now=215, window=60)
+    assert snapshot["count"] == 2
+    assert snapshot["mean"] == pytest.approx(70.0)
+    assert snapshot["variance"] == pytest.approx(200.0)
+    assert (snapshot["min"], snapshot["max"]) == (60.0, 80.0)
+    assert snapshot["total_count"] == 4
+    assert snapshot["total_mean"] == pytest.approx(85.0)
+    assert stats.snapshot(now=1000, window=60)["mean"] is None
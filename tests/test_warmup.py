@@ -0,0 +1,32 @@
+import asyncio
+
+import pytest
+from databases import Database
+
+import warmup
+from conftest import SHARD_URLS, migrate
+
+pytestmark = pytest.mark.skipif(not SHARD_URLS, reason="needs TEST_SHARD_DATABASE_URLS")
+
+
+def setup_module():
+    migrate(SHARD_URLS[:1])
+
+
+def test_warm_up_touches_distinct_pooled_connections(monkeypatch):
+    seen = []
+
+    async def record(connection):
+        seen.append(connection.raw_connection)
+
+    async def scenario():
+        database = Database(SHARD_URLS[0], min_size=3, max_size=5)
+        await database.connect()
+        try:
+            return await warmup.warm_up(database, connections=3)
+        finally:
+            await database.disconnect()
+
+    monkeypatch.setattr(warmup, "_run_hot_queries", record)
+    assert asyncio.run(scenario()) == 3
+    assert len({id(connection) for connection in seen}) == 3
@@ -0,0 +1,91 @@
+import asyncio
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+from databases import Database
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+from tables import vital_types
+
+# id — smallint: потолок справочника, чтобы сломанный монитор не забил его мусором.
+MAX_VITAL_TYPES = int(os.environ.get("MAX_VITAL_TYPES", "1000"))
+# Сколько помним, что типа нет, чтобы чтения по нему не ходили в БД каждый раз.
+MISSING_TTL = 5.0
+
+
+class UnknownVitalType(ValueError):
+    pass
+
+
+class VitalTypeCache:
+    # Имя типа показателя <-> smallint из vital_types. Справочник крошечный
+    # и почти не меняется, поэтому держим его целиком в памяти.
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.names: Dict[int, str] = {}
+        # Остальные шарды: id типов везде те же, что и на основной БД.
+        self.replicas: List[Database] = []
+        self._missing: Dict[str, float] = {}
+
+    async def load(self, database: Database):
+        rows = await database.fetch_all(vital_types.select())
+        for row in rows:
+            self._remember(row.get("name"), row.get("id"))
+
+    def name_of(self, type_id: int) -> str:
+        return self.names.get(type_id, "")
+
+    async def find(self, database: Database, name: str) -> Optional[int]:
+        # Для чтения: неизвестный тип не создаём, но мог появиться в другом процессе,
+        # поэтому промах проверяем в БД не чаще раза в MISSING_TTL.
+        type_id = self.ids.get(name)
+        if type_id is not None or self._missing.get(name, 0.0) > time.monotonic():
+            return type_id
+        query = select((vital_types.c.id,)).where(vital_types.c.name == name)
+        type_id = await database.fetch_val(query)
+        if type_id is not None:
+            self._remember(name, type_id)
+        else:
+            if len(self._missing) >= MAX_VITAL_TYPES:
+                self._missing.clear()
+            self._missing[name] = time.monotonic() + MISSING_TTL
+        return type_id
+
+    async def find_many(self, database: Database, names: Iterable[str]) -> List[int]:
+        result = []
+        for name in names:
+            type_id = await self.find(database, name)
+            if type_id is not None:
+                result.append(type_id)
+        return result
+
+    async def resolve(self, database: Database, name: str, create: bool = True) -> int:
+        # Для записи: неизвестный тип заводим, если create и справочник не упёрся в потолок.
+        type_id = self.ids.get(name)
+        if type_id is None:
+            self._missing.pop(name, None)
+            type_id = await self.find(database, name)
+        if type_id is None:
+            if not create:
+                raise UnknownVitalType(name)
+            if len(self.ids) >= MAX_VITAL_TYPES:
+                raise UnknownVitalType("{}: vital types limit of {} reached".format(name, MAX_VITAL_TYPES))
+            await database.execute(insert(vital_types).values(name=name).on_conflict_do_nothing())
+            # Промах только что запомнен в _missing — перечитываем мимо него.
+            self._missing.pop(name, None)
+            type_id = await self.find(database, name)
+            query = insert(vital_types).values(id=type_id, name=name).on_conflict_do_nothing()
+            await asyncio.gather(*(replica.execute(query) for replica in self.replicas))
+        return type_id
+
+    def any_name(self) -> Optional[str]:
+        return next(iter(self.ids), None)
+
+    def _remember(self, name: str, type_id: int):
+        self.ids[name] = type_id
+        self.names[type_id] = name
+
+
+vital_type_cache = VitalTypeCache()
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+
+from databases import Database
+
+from db import DB_POOL_MIN_SIZE, spawn
+from models import RoomsRepository, StatsPatientRepo
+from vital_types import vital_type_cache
+
+logger = logging.getLogger(__name__)
+
+ACQUIRE_TIMEOUT = 5.0
+
+
+# Горячие запросы репозиториев. asyncpg кэширует подготовленные выражения
+# на каждом соединении, поэтому прогоняем их на всех соединениях пула.
+async def _run_hot_queries(connection):
+    rooms_repository = RoomsRepository(database=connection)
+    stats_repository = StatsPatientRepo(database=connection)
+    await rooms_repository.get_all()
+    # С неизвестным типом репозиторий не доходит до запросов к показаниям, поэтому берём любой существующий.
+    type_ = vital_type_cache.any_name()
+    if type_ is None:
+        return
+    await stats_repository.get_n_last_values(patient_id=0, type_=type_)
+    await stats_repository.get_n_last_values_room(room_id=0, type_=type_)
+    await stats_repository.get_stats_room(type_=type_, room_id=0)
+    await stats_repository.get_setted_params(room_id=0, type_=[type_])
+
+
+async def _warm_connection(database: Database, acquired: list, all_acquired: asyncio.Event, total: int):
+    async with database.connection() as connection:
+        # Держим соединение, пока остальные не возьмут свои, иначе пул
+        # будет отдавать одно и то же соединение всем задачам.
+        acquired.append(connection)
+        if len(acquired) == total:
+            all_acquired.set()
+        try:
+            await asyncio.wait_for(all_acquired.wait(), timeout=ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        await _run_hot_queries(connection)
+
+
+async def warm_up(database: Database, connections: int = DB_POOL_MIN_SIZE):
+    await vital_type_cache.load(database)
+    connections = max(connections, 1)
+    acquired = []
+    all_acquired = asyncio.Event()
+    # load выше уже закрепил соединение за этой задачей, поэтому прогревающие — из пустого контекста.
+    results = await asyncio.gather(
+        *(spawn(_warm_connection(database, acquired, all_acquired, connections)) for _ in range(connections)),
+        return_exceptions=True,
+    )
+    failed = [r for r in results if isinstance(r, Exception)]
+    for error in failed:
+        logger.warning("warm-up query failed: %r", error)
+    return connections - len(failed)